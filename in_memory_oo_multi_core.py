@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 from shapely.geometry.polygon import Polygon
+from shapely.geometry import MultiPolygon
 import datetime
 import netCDF4 as nc
 import itertools
@@ -10,14 +11,48 @@ from shapely.ops import cascaded_union
 #from openclimategis.util.toshp import OpenClimateShp
 #from shapely.geometry.multipolygon import MultiPolygon, MultiPolygonAdapter
 from shapely import prepared #, wkt
+from shapely.wkb import loads as load_wkb
 #from shapely.geometry.geo import asShape
 import time #, sys
-from multiprocessing import Process, Queue, Lock
-from math import sqrt
+from multiprocessing import Lock, Pool, cpu_count
+import Queue
+import traceback
+import struct
+import gzip
+import hashlib
+from array import array
+import threading
+from math import sqrt, ceil
 import os
 from osgeo import osr, ogr
+from util.overlay_cache import OverlayCache
+from util.grid import CellGrid, bounds_window
+from util.read_plan import ReadPlanner
+from util.element_table import ElementTable, SHARED_PREFIX, remove_shared
+from util.helpers import get_temp_path, mask_fill
 
 dtime = 0
+## relative area below which a cell overlap is treated as floating point noise
+OVERLAY_TOLERANCE = 1e-10
+## cell labels assigned by classify_cells
+CELL_OUTSIDE = 0
+CELL_INSIDE = 1
+CELL_BOUNDARY = 2
+## cost of clipping a boundary cell per polygon vertex relative to the cost
+## of one cell value (one time step of one level). used to partition work.
+VERTEX_COST = 0.05
+## requests with fewer tasks than workers are split along the time axis if
+## their window has at most TIME_SPLIT_CELLS cells. a time block has at least
+## MIN_TIME_BLOCK steps.
+TIME_SPLIT_CELLS = 10000
+MIN_TIME_BLOCK = 32
+## planned reads are held in shared memory until the extraction finishes.
+## larger plans are not made and the workers read their own data.
+READ_PLAN_BYTES = 512*1024*1024
+## zonal means read their window in blocks of about ZONAL_BLOCK_VALUES values
+ZONAL_BLOCK_VALUES = 1000000
+## seconds between the checks for dead pool workers while waiting for results
+WORKER_POLL = 0.5
 
 class OcgDataset(object):
     """
@@ -31,6 +66,10 @@ class OcgDataset(object):
         time_name
         time_units
         calendar
+        overlay -- 'vectorized' (default) computes cell overlap areas in bulk.
+            'loop' intersects each cell with the polygon individually.
+        overlay_cache -- directory of an on-disk overlay cache
+        overlay_cache_size -- maximum size of the overlay cache in bytes
     """
     
     def __init__(self,dataset,**kwds):
@@ -54,6 +93,7 @@ class OcgDataset(object):
         self.time_units = kwds.get('time_units') or 'days since 1950-01-01 00:00:00'
         self.calendar = kwds.get('calendar') or 'proleptic_gregorian'
         self.level_name = kwds.get('level_name') or 'levels'
+        self.overlay = kwds.get('overlay') or 'vectorized'
 #        self.clip = kwds.get('clip') or False
 #        self.dissolve = kwds.get('dissolve') or False
 #        self.polygon = kwds.get('polygon')
@@ -69,24 +109,49 @@ class OcgDataset(object):
         ## extract the row and column bounds from the dataset
         self.row_bnds = self.dataset.variables[self.rowbnds_name][:]
         self.col_bnds = self.dataset.variables[self.colbnds_name][:]
-        ## convert the time vector to datetime objects
-        self.timevec = nc.netcdftime.num2date(self.dataset.variables[self.time_name][:],
-                                              self.time_units,
-                                              self.calendar)
+        ## the time vector is kept numeric. datetime objects are created only
+        ## for the selected time indices.
+        self.timenum = np.ma.getdata(self.dataset.variables[self.time_name][:])
+        self._timevec = None
         
-        ## these are base numpy arrays used by spatial operations. -------------
-
-        ## four numpy arrays one for each bounding coordinate of a polygon
-        self.min_col,self.min_row = np.meshgrid(self.col_bnds[:,0],self.row_bnds[:,0])
-        self.max_col,self.max_row = np.meshgrid(self.col_bnds[:,1],self.row_bnds[:,1])
-        ## these are the original indices of the row and columns. they are
-        ## referenced after the spatial subset to retrieve data from the dataset
-        self.real_col,self.real_row = np.meshgrid(np.arange(0,len(self.col_bnds)),
-                                                  np.arange(0,len(self.row_bnds)))
+        ## the grid used by spatial operations. only the 1-d bounds are held;
+        ## 2-d coordinate arrays are broadcast views created on demand.
+        self.grid = CellGrid(self.row_bnds,self.col_bnds)
+        ## wkb of the box geometries of grid cells keyed by (row,col) reused
+        ## across overlays
+        self._cell_cache = {}
+        ## wall time, number of reads and shape of each block read
+        self.read_log = []
+        ## block of pre-read data covering this dataset's reads. set by a read
+        ## planner.
+        self.block = None
+        ## optional on-disk cache of overlay results
+        self.cache = None
+        if kwds.get('overlay_cache'):
+            self.cache = OverlayCache(kwds['overlay_cache'],kwds.get('overlay_cache_size'))
+            self._grid_key = self.cache.fingerprint(self.row_bnds,self.col_bnds)
+
+    ## one array for each bounding coordinate of the grid cells
+    min_col = property(lambda self: self.grid.min_col)
+    min_row = property(lambda self: self.grid.min_row)
+    max_col = property(lambda self: self.grid.max_col)
+    max_row = property(lambda self: self.grid.max_row)
+    ## the original indices of the rows and columns
+    real_col = property(lambda self: self.grid.real_col)
+    real_row = property(lambda self: self.grid.real_row)
+
+    @property
+    def timevec(self):
+        "The whole time vector as datetime objects."
+        if self._timevec is None:
+            self._timevec = self._num2date_(np.arange(len(self.timenum)))
+        return(self._timevec)
 
     def __del__(self):
         try:
-            self.dataset.close()
+            ## the id of a closed dataset may have been reused by another one
+            if self.dataset.isopen():
+                self.dataset.close()
         except:
             pass
 
@@ -97,23 +162,22 @@ class OcgDataset(object):
         for ii,jj in itertools.product(xrange(ix),xrange(jx)):
             yield ii,jj
             
-    def _contains_(self,grid,lower,upper):
-        
-        ## small ranges on coordinates requires snapping to closest coordinate
-        ## to ensure values are selected through logical comparison.
-        ugrid = np.unique(grid)
-        lower = ugrid[np.argmin(np.abs(ugrid-lower))]
-        upper = ugrid[np.argmin(np.abs(ugrid-upper))]
+    def _window_(self,polygon=None):
+        """
+        Row and column index ranges of the cells overlapping the polygon's
+        envelope. The whole grid if polygon is None.
         
-        s1 = grid >= lower
-        s2 = grid <= upper
-        ret = s1*s2
-
-        return(ret)
+        Returns (first row, last row + 1, first col, last col + 1).
+        """
+        if polygon is None:
+            return(0,len(self.row_bnds),0,len(self.col_bnds))
+        emin_col,emin_row,emax_col,emax_row = polygon.envelope.bounds
+        return(self.grid.window(emin_row,emax_row,emin_col,emax_col))
             
     def _set_overlay_(self,polygon=None,clip=False):
         """
-        Perform spatial operations.
+        Perform spatial operations. Clipped cell geometries are not built
+        here but by _geometries_ once they are needed.
         
         polygon=None -- shapely polygon object
         clip=False -- set to True to perform an intersection
@@ -121,132 +185,180 @@ class OcgDataset(object):
         
         if self.verbose>1: print('overlay...')
         
-        ## holds polygon objects
-        self._igrid = np.empty(self.min_row.shape,dtype=object)
-        ## hold point objects
-        self._jgrid = np.empty(self.min_row.shape,dtype=object)
+        self._set_clip_(polygon,clip)
+        ## only the cells overlapping the polygon's envelope are considered.
+        ## the overlay arrays cover this window of the grid.
+        r0,r1,c0,c1 = self._window_(polygon)
+        self._window = (r0,c0)
+        shape = (r1-r0,c1-c0)
+        ## holds clipped polygon objects once built. None for whole cells.
+        self._igrid = np.empty(shape,dtype=object)
         ##holds locations that would be partial if the data were clipped for use in dissolve
-        self._pgrid = np.zeros(self.min_row.shape,dtype=bool)
+        self._pgrid = np.zeros(shape,dtype=bool)
         ## holds weights for area weighting in the case of a dissolve
-        self._weights = np.zeros(self.min_row.shape)
-        ## initial subsetting to avoid iterating over all polygons unless abso-
-        ## lutely necessary
-        if polygon is not None:
-            emin_col,emin_row,emax_col,emax_row = polygon.envelope.bounds
-            #print emin_col,emin_row,emax_col,emax_row
-            #print self.min_col
-            #print self.max_col
-            #print self.min_row
-            #print self.max_row
-#            ipdb.set_trace()
-            smin_col = self._contains_(self.min_col,emin_col,emax_col)
-            smax_col = self._contains_(self.max_col,emin_col,emax_col)
-            smin_row = self._contains_(self.min_row,emin_row,emax_row)
-            smax_row = self._contains_(self.max_row,emin_row,emax_row)
-            #print smin_col
-            #print smax_col
-            #print smin_row
-            #print smax_row
-            #include = smin_col*smax_col*smin_row*smax_row
-            include = np.any((smin_col,smax_col),axis=0)*np.any((smin_row,smax_row),axis=0)
-            #print include
-        else:
-            include = np.empty(self.min_row.shape,dtype=bool)
-            include[:,:] = True
-        
-#        print('constructing grid...')
-#        ## construct the subset of polygon geometries
-#        vfunc = np.vectorize(self._make_poly_array_)
-#        self._igrid = vfunc(include,
-#                            self.min_row,
-#                            self.min_col,
-#                            self.max_row,
-#                            self.max_col,
-#                            polygon)
-#        
-#        ## calculate the areas for potential weighting
-#        print('calculating area...')
-#        def _area(x):
-#            if x != None:
-#                return(x.area)
-#            else:
-#                return(0.0)
-#        vfunc_area = np.vectorize(_area,otypes=[np.float])
-#        preareas = vfunc_area(self._igrid)
-#        
-#        ## if we are clipping the data, modify the geometries and record the weights
-#        if clip and polygon:
-#            print('clipping...')
-##            polys = []
-##            for p in self._igrid.reshape(-1):
-##                polys.append(self._intersection_(polygon,p))
-#            vfunc = np.vectorize(self._intersection_)
-#            self._igrid = vfunc(polygon,self._igrid)
-#            
-#        ## calculate weights following intersection
-#        areas = vfunc_area(self._igrid)
-#        def _weight(x,y):
-#            if y == 0:
-#                return(0.0)
-#            else:
-#                return(x/y)
-#        self._weights=np.vectorize(_weight)(areas,preareas)
-#        
-#        ## set the mask
-#        self._mask = self._weights > 0
-#        
-#        print('overlay done.')
+        self._weights = np.zeros(shape)
         
-        ## loop for each spatial grid element
-#        tr()
-        if polygon:
-#            prepared_polygon = polygon
-            prepared_polygon = prepared.prep(polygon)
-        for ii,jj in self._itr_array_(include):
-            if not include[ii,jj]: continue
-            ## create the polygon
-            g = self._make_poly_((self.min_row[ii,jj],self.max_row[ii,jj]),
-                                 (self.min_col[ii,jj],self.max_col[ii,jj]))
-
-            ## add the polygon if it intersects the aoi of if all data is being
-            ## returned.
-            if polygon:
-                if not prepared_polygon.intersects(g): continue
-
-
-            if polygon.intersection(g).area==0:
-                continue
-#            if g.intersects(polygon) or polygon is None:
-                ## get the area before the intersection
-            prearea = g.area
-            ## full intersection in the case of a clip and an aoi is passed
-#                if g.overlaps(polygon) and clip is True and polygon is not None:
-            if clip is True and polygon is not None:
-                ng = g.intersection(polygon)
-            ## otherwise, just keep the geometry
-            else:
-                ng = g
-                #check if the geometry partially intersects the AoI
-                #without this multiple features covering the same location will 
-                #occur when threading is enabled
-                if g.intersection(polygon).area<g.area and g.intersection(polygon).area>0:
-                    self._pgrid[ii,jj]=True
-            ## calculate the weight
-            w = ng.area/prearea
-
-            ## a polygon can have a true intersects but actually not overlap
-            ## i.e. shares a border.
-            if w > 0:
-                self._igrid[ii,jj] = ng
-                self._weights[ii,jj] = w
-                self._jgrid[ii,jj] = (g.centroid.x,g.centroid.y)
+        ## window and grid indices and bounding coordinates of the candidate cells
+        ii = np.repeat(np.arange(shape[0]),shape[1])
+        jj = np.tile(np.arange(shape[1]),shape[0])
+        rows,cols = ii+r0,jj+c0
+        min_col,min_row,max_col,max_row = self._cell_bounds_(rows,cols)
+        ## area of each candidate cell and the area of its overlap with the aoi
+        prearea = (max_col-min_col)*(max_row-min_row)
+        area = self._overlap_areas_(polygon,rows,cols,min_col,min_row,max_col,max_row)
+        ## a polygon can have a true intersects but actually not overlap
+        ## i.e. shares a border. the tolerance absorbs floating point noise
+        ## from the bulk area computation.
+        tol = prearea*OVERLAY_TOLERANCE
+        keep = area > tol
+        ii,jj,rows,cols = ii[keep],jj[keep],rows[keep],cols[keep]
+        min_col,min_row,max_col,max_row = min_col[keep],min_row[keep],max_col[keep],max_row[keep]
+        area,prearea,tol = area[keep],prearea[keep],tol[keep]
+        ## cells only partially covered by the aoi
+        partial = area < prearea-tol
+        ## calculate the weight
+        if clip is True and polygon is not None:
+            self._weights[ii,jj] = np.where(partial,area/prearea,1.0)
+        else:
+            self._weights[ii,jj] = 1.0
+            #check if the geometry partially intersects the AoI
+            #without this multiple features covering the same location will 
+            #occur when threading is enabled
+            self._pgrid[ii,jj] = partial
         ## the mask is used as a subset
         self._mask = self._weights > 0
-        #print self._mask
-        #print self._pgrid
-#        self._weights = self._weights/self._weights.sum()
-        #print self._weights
-        #print self._mask.shape
+        
+    def _set_clip_(self,polygon=None,clip=False):
+        "Keep the polygon partial cells are clipped to. None without a clip."
+        if clip is True and polygon is not None:
+            self._clip = polygon
+        else:
+            self._clip = None
+        
+    def _cell_bounds_(self,rows,cols):
+        """
+        Bounding coordinates of cells given 1-d ndarrays of row and column
+        indices. Bounds may be stored as [lo,hi] or [hi,lo] (i.e. descending
+        latitudes).
+        
+        Returns min_col, min_row, max_col and max_row as float ndarrays.
+        """
+        col = self.col_bnds[cols].astype(float)
+        row = self.row_bnds[rows].astype(float)
+        return(col.min(axis=1),row.min(axis=1),col.max(axis=1),row.max(axis=1))
+    
+    def _overlap_areas_(self,polygon,ii,jj,min_col,min_row,max_col,max_row):
+        """
+        Area of overlap between the polygon and the candidate cells.
+        
+        polygon -- shapely polygon object or None to select whole cells
+        ii,jj -- 1-d ndarrays of the candidate cell row and column indices
+        min_col,min_row,max_col,max_row -- 1-d ndarrays of candidate cell bounds
+        """
+        if polygon is None:
+            area = (max_col-min_col)*(max_row-min_row)
+        elif self.overlay == 'loop':
+            area = self._loop_areas_(polygon,min_col,min_row,max_col,max_row)
+        elif is_rectangle(polygon):
+            area = rectangle_overlap_areas(polygon.bounds,min_col,min_row,max_col,max_row)
+        else:
+            ## cells fully inside or outside the aoi are resolved by testing
+            ## their corners. only boundary cells require the exact overlap.
+            rows,cols = np.unique(ii),np.unique(jj)
+            label = classify_cells(polygon,
+                                   self.col_bnds[cols],
+                                   self.row_bnds[rows])
+            label = label[np.searchsorted(rows,ii),np.searchsorted(cols,jj)]
+            area = np.where(label == CELL_INSIDE,(max_col-min_col)*(max_row-min_row),0.0)
+            boundary = label == CELL_BOUNDARY
+            area[boundary] = cell_overlap_areas(polygon,
+                                                min_col[boundary],
+                                                min_row[boundary],
+                                                max_col[boundary],
+                                                max_row[boundary])
+        return(area)
+        
+    def _cell_wkb_(self,row,col):
+        "Return the cached WKB of the box geometry of a grid cell."
+        key = (row,col)
+        if key not in self._cell_cache:
+            ## same ring as _make_poly_
+            (r0,r1),(c0,c1) = self.row_bnds[row],self.col_bnds[col]
+            self._cell_cache[key] = struct.pack('<BIII10d',1,3,1,5,
+                                                c0,r0,c0,r1,c1,r1,c1,r0,c0,r0)
+        return(self._cell_cache[key])
+
+    def _cell_poly_(self,row,col):
+        "Return the box geometry of a grid cell."
+        return(load_wkb(self._cell_wkb_(row,col)))
+
+    def _clip_cell_(self,row,col,polygon,rectangle=None):
+        """
+        Return the box geometry of a grid cell clipped to a polygon.
+        
+        rectangle=None -- True if the polygon is an axis-aligned rectangle.
+            tested if None.
+        """
+        if rectangle is None:
+            rectangle = is_rectangle(polygon)
+        if not rectangle:
+            return(self._cell_poly_(row,col).intersection(polygon))
+        ## clipping to a rectangle only shrinks the cell bounds
+        min_col,min_row,max_col,max_row = [b[0] for b in self._cell_bounds_(np.array([row]),np.array([col]))]
+        emin_col,emin_row,emax_col,emax_row = polygon.bounds
+        return(self._make_poly_((max(min_row,emin_row),min(max_row,emax_row)),
+                                (max(min_col,emin_col),min(max_col,emax_col))))
+
+    def cell_geometry(self,cell,polygon=None):
+        """
+        Box geometry of a grid cell given its index row*columns+column.
+        
+        polygon=None -- polygon to clip the box to
+        """
+        row,col = divmod(int(cell),len(self.col_bnds))
+        if polygon is None:
+            return(self._cell_poly_(row,col))
+        return(self._clip_cell_(row,col,polygon))
+
+    def cell_wkb(self,cell):
+        "WKB of the box geometry of a grid cell given its index row*columns+column."
+        return(self._cell_wkb_(*divmod(int(cell),len(self.col_bnds))))
+
+    def _geometries_(self,select):
+        """
+        Geometries of the cells selected by a boolean array over the overlay
+        window. Partial cells of a clip are clipped on first access and kept
+        by the overlay. Whole cells are built from the cell cache.
+        """
+        r0,c0 = self._window
+        rr,cc = np.nonzero(select)
+        rectangle = None
+        ret = []
+        for r,c,g in zip(rr,cc,self._igrid[rr,cc]):
+            if g is None:
+                if self._clip is not None and self._weights[r,c] < 1:
+                    if rectangle is None:
+                        rectangle = is_rectangle(self._clip)
+                    g = self._clip_cell_(r0+r,c0+c,self._clip,rectangle)
+                    self._igrid[r,c] = g
+                else:
+                    g = self._cell_poly_(r0+r,c0+c)
+            ret.append(g)
+        return(ret)
+        
+    def _loop_areas_(self,polygon,min_col,min_row,max_col,max_row):
+        """
+        Overlap areas computed by intersecting each cell with the polygon. Used
+        by the 'loop' overlay mode and as a reference for the bulk engine.
+        """
+        prepared_polygon = prepared.prep(polygon)
+        area = np.zeros(len(min_col))
+        for idx in xrange(len(min_col)):
+            g = self._make_poly_((min_row[idx],max_row[idx]),
+                                 (min_col[idx],max_col[idx]))
+            if prepared_polygon.intersects(g):
+                area[idx] = polygon.intersection(g).area
+        return(area)
     
     def _make_poly_(self,rtup,ctup):
         """
@@ -283,52 +395,111 @@ class OcgDataset(object):
                 ret = ppp
         return(ret)
         
-    def _get_numpy_data_(self,var_name,polygon=None,time_range=None,clip=False,levels = [0],lock=Lock()):
+    def _set_spatial_(self,polygon=None,clip=False):
         """
-        var_name -- NC variable to extract from
+        Perform the overlay and subset the reference arrays to the window of
+        selected cells. The windowed overlay is read from and stored in the
+        overlay cache when one is configured.
+        
         polygon=None -- shapely polygon object
-        time_range=None -- [lower datetime, upper datetime]
-        clip=False -- set to True to perform a full intersection
+        clip=False -- set to True to perform an intersection
         """
-        if self.verbose>1: print('getting numpy data...')
-
-        ## perform the spatial operations
+        if self.cache is not None:
+            key = self.overlay_key(polygon,clip)
+            entry = self.cache.get(key)
+            if entry is not None:
+                if self.verbose>1: print('overlay cache hit...')
+                self._load_overlay_(entry)
+                self._set_clip_(polygon,clip)
+                return
+        
         self._set_overlay_(polygon=polygon,clip=clip)
-
-        def _u(arg):
-            "Pulls unique values and generates an evenly spaced array."
-            un = np.unique(arg)
-            ret = np.arange(un.min(),un.max()+1)
-            return(ret)
         
+        def _u(arg,offset):
+            "Generates an evenly spaced array over the selected indices."
+            if not arg.any():
+                return(np.zeros(0,dtype=int))
+            idx = np.nonzero(arg)[0]
+            return(np.arange(idx[0],idx[-1]+1)+offset)
+        
+        r0,c0 = self._window
         def _sub(arg):
             "Subset an array."
-            return arg[self._idxrow.min():self._idxrow.max()+1,
-                       self._idxcol.min():self._idxcol.max()+1]
-        
-        ## get the time indices
-        if time_range is not None:
-            self._idxtime = np.arange(
-             0,
-             len(self.timevec))[(self.timevec>=time_range[0])*
-                                (self.timevec<=time_range[1])]
-        else:
-            self._idxtime = np.arange(0,len(self.timevec))
+            if len(self._idxrow) == 0 or len(self._idxcol) == 0:
+                return arg[0:0,0:0]
+            return arg[self._idxrow[0]-r0:self._idxrow[-1]-r0+1,
+                       self._idxcol[0]-c0:self._idxcol[-1]-c0+1]
         
         ## reference the original (world) coordinates of the netCDF when selecting
         ## the spatial subset.
-        self._idxrow = _u(self.real_row[self._mask])
-        self._idxcol = _u(self.real_col[self._mask])
+        self._idxrow = _u(self._mask.any(axis=1),r0)
+        self._idxcol = _u(self._mask.any(axis=0),c0)
          
         ## subset our reference arrays in a similar manner
         self._mask = _sub(self._mask)
         self._weights = _sub(self._weights)
         self._igrid = _sub(self._igrid)
-        self._jgrid = _sub(self._jgrid)
+        if len(self._idxrow) > 0 and len(self._idxcol) > 0:
+            self._window = (self._idxrow[0],self._idxcol[0])
         self._pgrid = _sub(self._pgrid)
         
-        ## hit the dataset and extract the block
-        npd = None
+        if self.cache is not None:
+            self.cache.put(key,self._dump_overlay_())
+            
+    def overlay_key(self,polygon=None,clip=False):
+        "Overlay cache key for a polygon and clip flag on this dataset's grid."
+        return(self.cache.key(self._grid_key,polygon,clip))
+            
+    def _dump_overlay_(self):
+        """
+        Return the windowed overlay as a dictionary of arrays for the overlay
+        cache. Clipped geometries are rebuilt from the polygon when needed.
+        """
+        entry = dict(idxrow=self._idxrow,
+                     idxcol=self._idxcol,
+                     mask=self._mask,
+                     weights=self._weights,
+                     pgrid=self._pgrid)
+        return(entry)
+    
+    def _load_overlay_(self,entry):
+        """
+        Restore the windowed overlay from an overlay cache entry. The clip
+        polygon is set by the caller.
+        """
+        self._idxrow = entry['idxrow']
+        self._idxcol = entry['idxcol']
+        self._mask = entry['mask']
+        self._weights = entry['weights']
+        self._pgrid = entry['pgrid']
+        self._igrid = np.empty(self._mask.shape,dtype=object)
+        if len(self._idxrow) > 0 and len(self._idxcol) > 0:
+            self._window = (self._idxrow[0],self._idxcol[0])
+        
+    def _get_numpy_data_(self,var_name,polygon=None,time_range=None,clip=False,levels = [0],lock=None,time_block=None,overlay=None):
+        """
+        var_name -- NC variable to extract from
+        polygon=None -- shapely polygon object
+        time_range=None -- [lower datetime, upper datetime]
+        clip=False -- set to True to perform a full intersection
+        lock=None -- multiprocessing Lock shared by the processes reading the
+            file. None reads without locking.
+        time_block=None -- (start,stop) positions within the selected time
+            indices to extract
+        overlay=None -- overlay entry from _dump_overlay_ to use instead of
+            performing the spatial operations
+        """
+        if self.verbose>1: print('getting numpy data...')
+
+        ## perform the spatial operations
+        if overlay is not None:
+            self._load_overlay_(overlay)
+            self._set_clip_(polygon,clip)
+        else:
+            self._set_spatial_(polygon=polygon,clip=clip)
+        
+        ## get the time indices
+        self._set_time_(time_range,time_block)
 
         #print an error message and return if the selection doesn't include any data
         if len(self._idxrow)==0:
@@ -341,67 +512,234 @@ class OcgDataset(object):
             if self.verbose>0: print "Invalid Selection, unable to select time range"
             return
         
+        ## hit the dataset and extract the block
+        npd = self._read_block_(var_name,levels,lock)
+        if npd is not None:
+            npd = mask_fill(npd,self.dataset.variables[var_name])
+        
+        if self.verbose>1: print('numpy extraction done.')
+        
+        return(npd)
+    
+    def _set_time_(self,time_range=None,block=None):
+        """
+        Set the time indices selected by time_range=[lower datetime, upper
+        datetime] and their datetime objects in _timestamps.
+        
+        block=None -- (start,stop) positions within the selected indices to
+            keep
+        """
+        if time_range is not None:
+            ## compare in the numeric units of the time vector
+            lower,upper = nc.date2num(list(time_range),self.time_units,self.calendar)
+            if (np.diff(self.timenum) >= 0).all():
+                self._idxtime = np.arange(np.searchsorted(self.timenum,lower,side='left'),
+                                          np.searchsorted(self.timenum,upper,side='right'))
+            else:
+                self._idxtime = np.nonzero((self.timenum >= lower)*(self.timenum <= upper))[0]
+        else:
+            self._idxtime = np.arange(0,len(self.timenum))
+        if block is not None:
+            self._idxtime = self._idxtime[block[0]:block[1]]
+        self._timestamps = self._num2date_(self._idxtime)
+        
+    def _num2date_(self,idx):
+        "Datetime objects of the time indices idx."
+        if len(idx) == 0:
+            return(np.empty(0,dtype=object))
+        return(np.atleast_1d(nc.netcdftime.num2date(self.timenum[idx],
+                                                    self.time_units,
+                                                    self.calendar)))
+    
+    def _read_block_(self,var_name,levels,lock):
+        """
+        Read the block of data selected by the time, row and column indices.
+        
+        var_name -- NC variable to extract from
+        levels -- level indices for 4-d variables
+        lock -- multiprocessing Lock guarding the file or None
+        """
+        npd = None
         narg = time.clock()
 
-        #attempt to aquire the file lock
-        while not(lock.acquire(False)):
-            time.sleep(.1)
-
         ##check if data is 3 or 4 dimensions
         dimShape = len(self.dataset.variables[var_name].dimensions)
 
-        #grab the data
-        if dimShape == 3:
-            npd = self.dataset.variables[var_name][self._idxtime,self._idxrow,self._idxcol]
-            # reshape the data if the selection causes a loss of dimension(s)
-            if len(npd.shape) <= 2:
-                npd = npd.reshape(len(self._idxtime),len(self._idxrow),len(self._idxcol))
-        elif dimShape == 4:
-            #check if 1 or more levels have been selected
-            if len(levels)==0:
-                if self.verbose>0: print "Invalid Selection, unable to select levels"
-                return
-
-            #grab level values
-            self.levels = self.dataset.variables[self.level_name][:]
+        #check if 1 or more levels have been selected
+        if dimShape == 4 and len(levels)==0:
+            if self.verbose>0: print "Invalid Selection, unable to select levels"
+            return
 
-            npd = self.dataset.variables[var_name][self._idxtime,levels,self._idxrow,self._idxcol]
+        ## the row, column and time indices are contiguous ranges and are read
+        ## as slices. fancy indexing is much slower in netCDF4-python.
+        tidx = _as_slice_(self._idxtime)
+        ridx = _as_slice_(self._idxrow)
+        cidx = _as_slice_(self._idxcol)
+        
+        ## take the data from a planned block if it covers the selection
+        if self.block is not None:
+            indices = [tidx,ridx,cidx]
+            if dimShape == 4:
+                indices.insert(1,np.asarray(levels))
+                self.levels = self.dataset.variables[self.level_name][:]
+            bounds = [(int(np.min(self._idxtime)),int(np.max(self._idxtime))+1),
+                      (self._idxrow[0],self._idxrow[-1]+1),
+                      (self._idxcol[0],self._idxcol[-1]+1)]
+            if dimShape == 4:
+                bounds.insert(1,(min(levels),max(levels)+1))
+            if self.block.covers(bounds):
+                if self.verbose>1: print "using planned block"
+                return(self.block.extract(indices))
+
+        #wait for the file lock. it is released even if the read fails so
+        #the other tasks are not blocked.
+        if lock is not None:
+            lock.acquire()
+        try:
+            start = time.time()
+        
+            #grab the data
+            if dimShape == 3:
+                npd = self.dataset.variables[var_name][tidx,ridx,cidx]
+                reads = 1
+                # reshape the data if the selection causes a loss of dimension(s)
+                if len(npd.shape) <= 2:
+                    npd = npd.reshape(len(self._idxtime),len(self._idxrow),len(self._idxcol))
+            elif dimShape == 4:
+                #grab level values
+                self.levels = self.dataset.variables[self.level_name][:]
+
+                ## levels are read in as few contiguous runs as possible
+                runs = [self.dataset.variables[var_name][tidx,run,ridx,cidx]
+                        for run in _level_runs_(levels)]
+                reads = len(runs)
+                if len(runs) == 1:
+                    npd = runs[0]
+                elif any(isinstance(r,np.ma.MaskedArray) for r in runs):
+                    npd = np.ma.concatenate(runs,axis=1)
+                else:
+                    npd = np.concatenate(runs,axis=1)
 
-            # reshape the data if the selection causes a loss of dimension(s)
-            if len(npd.shape)<=3:
-                npd = npd.reshape(len(self._idxtime),len(levels),len(self._idxrow),len(self._idxcol))
+                # reshape the data if the selection causes a loss of dimension(s)
+                if len(npd.shape)<=3:
+                    npd = npd.reshape(len(self._idxtime),len(levels),len(self._idxrow),len(self._idxcol))
 
-            #print self._weights
-    
-        #release the file lock
-        lock.release()
+                #print self._weights
+        finally:
+            if lock is not None:
+                lock.release()
+        
+        self.read_log.append(dict(var=var_name,
+                                  seconds=time.time()-start,
+                                  reads=reads,
+                                  shape=npd.shape))
 
         if self.verbose>1: print "dtime: ", time.clock()-narg
- 
-        
-        if self.verbose>1: print('numpy extraction done.')
         
         return(npd)
     
-    def _is_masked_(self,arg):
-        "Ensures proper formating of masked data for single-layer data."
-        if isinstance(arg,np.ma.MaskedArray):
-            return None
-        else:
-            return arg
-
-    def _is_masked2_(self,arg):
-        "Ensures proper formating of masked data for multi-layer data."
-        #print arg
-        if isinstance(arg[0],np.ma.MaskedArray):
-            return None
-        else:
-            return np.array(arg)
+    def zonal_means(self,var_name,polygons,time_range=None,levels=None,lock=None):
+        """
+        Area-weighted means of a variable for many polygons in one pass. A
+        sparse (polygon x cell) matrix of overlap weights is built over the
+        window covering all polygons, the window is read once in blocks of
+        time steps and the means of each block are computed as one sparse
+        matrix product. Masked cells are excluded by renormalizing the weights
+        at each time step.
+        
+        var_name -- NC variable to extract from
+        polygons -- sequence of shapely polygon objects
+        time_range=None -- [lower datetime, upper datetime]
+        levels=None -- level indices of a 4-d variable. all levels if None.
+        lock=None -- multiprocessing Lock guarding the file
+        
+        Returns a masked ndarray with shape (polygon,time) or (polygon,time,
+        level) for 4-d variables. Polygons not covering any data are masked
+        and every value is masked if no level is selected. The selected time
+        indices are stored in _idxtime.
+        """
+        if self.verbose>1: print('building weight matrix...')
+        pidx,rows,cols,weights = self._weight_matrix_(polygons)
+        self._set_time_(time_range)
+        
+        dimShape = len(self.dataset.variables[var_name].dimensions)
+        if dimShape == 4 and levels is None:
+            levels = range(len(self.dataset.variables[self.level_name]))
+        nlevels = len(levels) if dimShape == 4 else 1
+        shape = (len(polygons),len(self._idxtime))
+        if dimShape == 4:
+            shape += (nlevels,)
+        if len(pidx) == 0 or len(self._idxtime) == 0:
+            return(np.ma.masked_all(shape))
+        
+        ## the window covering every polygon is read in blocks of time steps
+        self._idxrow = np.arange(rows.min(),rows.max()+1)
+        self._idxcol = np.arange(cols.min(),cols.max()+1)
+        cells = (rows-self._idxrow[0])*len(self._idxcol)+(cols-self._idxcol[0])
+        idxtime = self._idxtime
+        nrows = len(idxtime)*nlevels
+        
+        ## the entries are sorted by polygon so each polygon is a contiguous
+        ## segment of the sparse matrix
+        present,starts = np.unique(pidx,return_index=True)
+        num = np.empty((nrows,len(present)))
+        den = np.empty((nrows,len(present)))
+        step = max(1,ZONAL_BLOCK_VALUES//(max(len(cells),len(self._idxrow)*len(self._idxcol))*max(nlevels,1)))
+        try:
+            for start in xrange(0,len(idxtime),step):
+                self._idxtime = idxtime[start:start+step]
+                npd = self._read_block_(var_name,levels,lock)
+                if npd is None:
+                    return(np.ma.masked_all(shape))
+                npd = mask_fill(npd,self.dataset.variables[var_name])
+                ## one row per time step (and level) and one column per window cell
+                block = npd.reshape(len(self._idxtime)*nlevels,-1)[:,cells]
+                valid = weights*np.invert(np.ma.getmaskarray(block))
+                span = slice(start*nlevels,(start+len(self._idxtime))*nlevels)
+                num[span] = np.add.reduceat(np.ma.getdata(block)*valid,starts,axis=1)
+                den[span] = np.add.reduceat(valid,starts,axis=1)
+        finally:
+            self._idxtime = idxtime
+        
+        ret = np.ma.masked_all((nrows,len(polygons)))
+        ret[:,present] = np.ma.masked_array(num/np.where(den > 0,den,1.0),mask=den <= 0)
+        return(ret.T.reshape(shape))
+    
+    def _weight_matrix_(self,polygons):
+        """
+        Sparse (polygon x cell) matrix of overlap weights in coordinate format
+        sorted by polygon. Weights are the fraction of each cell covered by the
+        polygon as in a clipped overlay.
+        
+        polygons -- sequence of shapely polygon objects
+        
+        Returns the polygon indices, cell row indices, cell column indices and
+        weights as 1-d ndarrays.
+        """
+        ret = [[],[],[],[]]
+        for ii,polygon in enumerate(polygons):
+            ## candidate cells within the polygon's envelope
+            r0,r1,c0,c1 = self._window_(polygon)
+            rows,cols = np.arange(r0,r1),np.arange(c0,c1)
+            rr = np.repeat(rows,len(cols))
+            cc = np.tile(cols,len(rows))
+            min_col,min_row,max_col,max_row = self._cell_bounds_(rr,cc)
+            prearea = (max_col-min_col)*(max_row-min_row)
+            area = self._overlap_areas_(polygon,rr,cc,min_col,min_row,max_col,max_row)
+            keep = area > prearea*OVERLAY_TOLERANCE
+            ret[0].append(np.ones(keep.sum(),dtype=int)*ii)
+            ret[1].append(rr[keep])
+            ret[2].append(cc[keep])
+            ret[3].append(np.minimum(area[keep]/prearea[keep],1.0))
+        if len(polygons) == 0:
+            return([np.zeros(0,dtype=int)]*3+[np.zeros(0)])
+        return([np.concatenate(r) for r in ret])
     
     def extract_elements(self,*args,**kwds):
         """
         Merges the geometries and extracted attributes into a GeoJson-like dictionary
-        list.
+        list. Without a dissolve the elements are put on the queue as an
+        ElementTable.
         
         var_name -- NC variable to extract from
         dissolve=False -- set to True to merge geometries and calculate an 
@@ -447,183 +785,79 @@ class OcgDataset(object):
         ocgShape = len(npd.shape)
         ## will hold feature dictionaries
         features = []
-        ## partial pixels
-        recombine = {}
         ## the unique identified iterator
         ids = self._itr_id_()
-        gpass = True
         if dissolve:
-            ## one feature is created for each unique time
-            for kk in range(len(self._idxtime)):
-                ## check if this is the first iteration. approach assumes that
-                ## masked values are homogenous through the time layers. this
-                ## avoids multiple union operations on the geometries. i.e.
-                ##    time 1 = masked, time 2 = masked, time 3 = masked
-                ##        vs.
-                ##    time 1 = 0.5, time 2 = masked, time 3 = 0.46
-                if kk == 0:
-                    ## on the first iteration:
-                    ##    1. make the unioned geometry
-                    ##    2. weight the data according to area
-                    
-                    ## reference layer for the masked data
-                    lyr = None
-
+            ## one weighted reduction over the time, level, row and column
+            ## axes. values masked at a time step or level are dropped by
+            ## renormalizing the weights of the remaining cells. cells
+            ## outside the polygon have a zero weight.
+            w = self._weights.ravel()
+            valid = np.invert(np.ma.getmaskarray(npd)).reshape(-1,w.size)
+            wsum = valid.dot(w).reshape(npd.shape[:-2])
+            total = np.ma.filled(npd,0).reshape(-1,w.size).dot(w).reshape(npd.shape[:-2])
+            avg = total/np.where(wsum > 0,wsum,1)
+            ## the dissolved geometry covers the cells holding a value at any time
+            select = valid.any(axis=0).reshape(self._mask.shape)*self._mask
+            geoms = self._geometries_(select)
+            #only bother with dissolve if there are one or more features that
+            #intersect the AoI
+            if len(geoms)>0:
+                ## union the geometries
+                unioned = cascaded_union([p for p in geoms])
+                ## one feature is created for each unique time
+                for kk in xrange(len(self._idxtime)):
+                    ## time steps without values are only kept for recombination
+                    if parent == None and not wsum[kk].any():
+                        continue
                     if ocgShape==3:
-                        lyr = npd[kk,:,:]
-                    elif ocgShape==4:
-                        lyr = npd[kk,0,:,:]
-                    ## select values with spatial overlap and not masked
-                    if hasattr(lyr,'mask'):
-                        select = self._mask*np.invert(lyr.mask)
+                        properties = {var:float(avg[kk])}
                     else:
-                        select = self._mask
-
-
-                    #cut out partial values
-                    if not clip:
-                        pselect = select*self._pgrid
-                        select *= np.invert(self._pgrid)
-
-                    ## select those geometries
-                    geoms = self._igrid[select]
-                    #print geoms
-                    if len(geoms)>0:
-                        ## union the geometries
-                        unioned = cascaded_union([p for p in geoms])
-                        ## select the weight subset and normalize to unity
-                        sub_weights = self._weights*select
-                        #print sub_weights
-                        #print unioned.area
-                        self._weights = sub_weights/sub_weights.sum()
-                        ## apply the weighting
-                        weighted = npd*self._weights
-                        #print self._weights
-                        #print weighted
-                        #print (npd*sub_weights).sum()
-                        #print select.sum()
-                        #weighted = npd/sub_weights.sum()*sub_weights
-                    else:
-                        gpass = False
-                ## generate the feature
-
-                #only bother with dissolve if there are one or more features that
-                #fully intersect the AoI
-                if gpass:
-                    if ocgShape==3:
-                        feature = dict(
-                            id=ids.next(),
-                            geometry=unioned,
-                            properties=dict({var:float(weighted[kk,:,:].sum()),
-                                            'timestamp':self.timevec[self._idxtime[kk]]}))
-                    elif ocgShape==4:
-                        feature = dict(
-                            id=ids.next(),
-                            geometry=unioned,
-                            properties=dict({var:float(list(weighted[kk,x,:,:].sum() for x in xrange(len(levels)))),
-                                            'timestamp':self.timevec[self._idxtime[kk]],
-                                            'levels':list(x for x in self.levels[levels])}))
-                    
+                        properties = {var:[float(x) for x in avg[kk]],
+                                      'levels':list(self.levels[levels])}
+                    properties['timestamp'] = self._timestamps[kk]
+                    feature = dict(id=ids.next(),geometry=unioned,properties=properties)
                     #record the weight used so the geometry can be
                     #properly recombined later
-                    if not(parent == None) and dissolve:
-                        feature['weight']=sub_weights.sum()
+                    if not(parent == None):
+                        feature['weight'] = wsum[kk].tolist()
                     features.append(feature)
-
-                #Record pieces that partially cover geometry so duplicates
-                #can later be filtered out the the unique values recombined
-                if not clip:
-                    for ii,jj in self._itr_array_(pselect):
-                        if self._pgrid[ii,jj]:
-                            ctr = self._jgrid[ii,jj]
-                            if kk==0:
-                                recombine[ctr] = []
-                            if ocgShape==3:
-                                feature = dict(
-                                    id=ids.next(),
-                                    geometry=self._igrid[ii,jj],
-                                    weight=1.0,
-                                    properties=dict({var:float(npd[kk,ii,jj]),
-                                                    'timestamp':self.timevec[self._idxtime[kk]]}))
-                                #print npd[kk,ii,jj]
-                            if ocgShape==4:
-                                feature = dict(
-                                    id=ids.next(),
-                                    geometry=self._igrid[ii,jj],
-                                    weight=1.0,
-                                    properties=dict({var:float(list(npd[kk,x,ii,jj] for x in xrange(len(levels)))),
-                                                    'timestamp':self.timevec[self._idxtime[kk]],
-                                                    'level':list(x for x in self.levels[levels])}))
-                            recombine[ctr].append(feature)
                             
         else:
-            #print self._mask
-            ctr = None
-            ## loop for each feature. no dissolving.
-            for ii,jj in self._itr_array_(self._mask):
-                ## if the data is included, add the feature
-                if self._mask[ii,jj] == True:
-                    #if the geometry has a fraction of a pixel, the other factions could be handled by a different thread
-                    #these must be recombined later, or if it's not clipped there will be duplicates to filter out
-                    if self._weights[ii,jj] < 1 or not clip:
-                        #tag the location this data value is at so it can be compared later
-                        ctr = self._jgrid[ii,jj]
-                        recombine[ctr] = []
-                    ## extract the data and convert any mask values
-                    #print ocgShape
-                    if ocgShape == 3:
-                        #if hasattr(npd,'mask'):
-                            #print np.invert(npd.mask)
-                        #else:
-                            #print 'no mask found'
-                        data = [self._is_masked_(da) for da in npd[:,ii,jj]]
-                        #print data
-                        for kk in range(len(data)):
-                            ## do not add the feature if the value is a NoneType
-                            if data[kk] == None: continue
-                            feature = dict(
-                                id=ids.next(),
-                                geometry=self._igrid[ii,jj],
-                                properties=dict({var:float(data[kk]),
-                                                'timestamp':self.timevec[self._idxtime[kk]]}))
-                            #if the data point covers a partial pixel or isn't clipped add it to the recombine set, otherwise leave it alone
-                            if self._weights[ii,jj] < 1 or (self._pgrid[ii,jj] and not clip):
-                                recombine[ctr].append(feature)
-                            else:
-                                features.append(feature)
-                            
-
-                    elif ocgShape == 4:
-                        #if hasattr(npd,'mask'):
-                            #print np.invert(npd.mask)
-                        #else:
-                            #print 'no mask found'
-                        if self._weights[ii,jj] < 1 or not clip:
-                            ctr = self._jgrid[ii,jj]
-                            recombine[ctr] = []
-
-                        data = [self._is_masked2_(da) for da in npd[:,:,ii,jj]]
-                        #print data
-                        for kk in range(len(data)):
-                            ## do not add the feature if the value is a NoneType
-                            if data[kk] == None: continue
-                            feature = dict(
-                                id=ids.next(),
-                                geometry=self._igrid[ii,jj],
-                                properties=dict({var:list(float(data[kk][x]) for x in xrange(len(levels))),
-                                                'timestamp':self.timevec[self._idxtime[kk]],
-                                                'level':list(x for x in self.levels[levels])}))
-                            #q.put(feature)
-                            if self._weights[ii,jj] < 1 or (self._pgrid[ii,jj] and not clip):
-                                recombine[ctr].append(feature)
-                            else:
-                                features.append(feature)
+            ## no dissolving. the cells are gathered into a columnar table.
+            ## masked values are found once for the block and cells masked at
+            ## every time step and level are dropped.
+            valid = np.invert(np.ma.getmaskarray(npd)).reshape((-1,)+self._mask.shape).any(axis=0)
+            rr,cc = np.nonzero(self._mask*valid)
+            cells = self._idxrow[rr]*len(self.col_bnds)+self._idxcol[cc]
+            if ocgShape == 3:
+                values = npd[:,rr,cc]
+                lvls = None
+            else:
+                values = np.ma.asarray(npd[:,:,rr,cc]).transpose(0,2,1)
+                lvls = self.levels[levels]
+            #cells are owned by a single task of each polygon but can be extracted
+            #for other polygons as well. fractions of clipped cells are recombined
+            #later and unclipped cells are kept once.
+            shared = (self._weights[rr,cc] < 1)+(not clip)
+            #geometries are built by the table when requested. partial cells
+            #of a clip keep the polygon they are clipped to.
+            geoms = self._igrid[rr,cc]
+            weights = self._weights[rr,cc]
+            clips = np.empty(len(cells),dtype=object)
+            if self._clip is not None:
+                for idx in np.nonzero(weights < 1)[0]:
+                    clips[idx] = self._clip
+            table = ElementTable(var,cells,geoms,self._timestamps,values,lvls,shared,self.cell_geometry,
+                                 weights,clips)
         if self.verbose>1: print('extraction complete.')
 
         if not(parent == None) and dissolve:
-            q.put((parent,features,recombine))
+            q.put((parent,features))
+        elif dissolve:
+            q.put(features)
         else:
-            q.put((features,recombine))
+            q.put(table)
         return
         #sys.exit(0)
         #return(features)
@@ -636,6 +870,7 @@ class OcgDataset(object):
                 start += 1
                 
 def as_geojson(elements):
+    "elements can be any iterable of elements."
     features = []
     for e in elements:
         e['properties']['timestamp'] = str(e['properties']['timestamp'])
@@ -650,72 +885,156 @@ def as_shp(elements,path=None):
     ocs.write()
     return(path)
 
-def as_tabular(elements,var,wkt=False,wkb=False,path = None):
+def _peek_(elements):
+    "Return the first element, or None, and an iterator over all elements."
+    elements = iter(elements)
+    for first in elements:
+        return(first,itertools.chain([first],elements))
+    return(None,elements)
+
+def as_tabular(elements,var,wkt=False,wkb=False,path = None,compress=False,block=100000):
     '''writes output in a tabular, CSV format
-geometry output is optional'''
-    import osgeo.ogr as ogr
+geometry output is optional. elements can be any iterable of elements, e.g.
+the chained chunks of multipolygon_multicore_iter, or an ElementTable.
+
+areas are computed once per unique geometry with one reused coordinate
+transformation and rows are written in blocks of block rows. set compress to
+True to write gzip compressed output.'''
 
     if path is None:
-        path = get_temp_path(suffix='.txt')
+        path = get_temp_path(suffix='.txt.gz' if compress else '.txt')
 
-    #define spatial references for the projection
-    sr = ogr.osr.SpatialReference()
-    sr.ImportFromEPSG(4326)
-    sr2 = ogr.osr.SpatialReference()
-    sr2.ImportFromEPSG(3005) #Albers Equal Area is used to ensure legitimate area values
+    area = _area_cache_()
+
+    if isinstance(elements,ElementTable) or elements is None:
+        levels = elements is not None and elements.levels is not None
+        lines = _table_lines_(elements,wkt,wkb,area)
+    else:
+        first,elements = _peek_(elements)
+        levels = first is not None and 'level' in first['properties'].keys()
+        lines = _element_lines_(elements,var,wkt,wkb,area)
+
+    opener = gzip.open if compress else open
+    with opener(path,'wb') as f:
 
-    with open(path,'w') as f:
-        
         #prepare column header
         header = ['id','timestamp',var]
-        if 'level' in elements[0]['properties'].keys():
-                header += ['level']
+        if levels:
+            header += ['level']
         header += ['area']
         if wkb:
             header += ['wkb']
-
         if wkt:
             header += ['wkt']
-        
-                
         f.write(','.join(header))
         f.write('\n')
-        
-        for ii,element in enumerate(elements):
-
-            #convert area from degrees to m^2
-            geo = ogr.CreateGeometryFromWkb(element['geometry'].wkb)
-            geo.AssignSpatialReference(sr)
-            geo.TransformTo(sr2)
-            area = geo.GetArea()
 
-            #write id, timestamp, variable
-            f.write(','.join([repr(ii+1),element['properties']['timestamp'].strftime("%Y-%m-%d %H:%M:%S"),repr(element['properties'][var])]))
+        _write_blocks_(f,lines,block)
 
-            #write level if the dataset has levels
-            if 'level' in element['properties'].keys():
-                f.write(','+repr(element['properties']['level']))
-
-            #write the area
-            f.write(','+repr(area))
-
-            #write wkb if requested
-            if wkb:
-                f.write(','+repr(element['geometry'].wkb))
-
-            #write wkt if requested
-            if wkt:
-                f.write(','+repr(element['geometry'].wkt))
+    return path
 
-            f.write('\n')
-        f.close()
+def _write_blocks_(f,lines,block):
+    "Write an iterable of lines to a file joined in blocks of block lines."
+    buf = []
+    for line in lines:
+        buf.append(line)
+        if len(buf) >= block:
+            f.write(''.join(buf))
+            buf = []
+    f.write(''.join(buf))
+
+def _area_cache_(keep=True):
+    """
+    Return a function giving the area in m^2 of a shapely geometry in
+    degrees. The geometry is projected to Albers Equal Area to ensure
+    legitimate area values with one transformation reused for every
+    geometry, and the area of each geometry object is computed once.
+    
+    keep=True -- set to False to not keep the areas, e.g. for geometries
+        measured only once
+    """
+    #define spatial references for the projection
+    sr = osr.SpatialReference()
+    sr.ImportFromEPSG(4326)
+    sr2 = osr.SpatialReference()
+    sr2.ImportFromEPSG(3005)
+    transform = osr.CoordinateTransformation(sr,sr2)
+    def _measure(geom):
+        geo = ogr.CreateGeometryFromWkb(geom.wkb)
+        geo.AssignSpatialReference(sr)
+        geo.Transform(transform)
+        return(geo.GetArea())
+    if not keep:
+        return(_measure)
+    ## id of the geometry -> (geometry,area). the geometry is kept so its id
+    ## is not reused.
+    cache = {}
+    def _area(geom):
+        key = id(geom)
+        if key not in cache:
+            cache[key] = (geom,_measure(geom))
+        return(cache[key][1])
+    return(_area)
+
+def _element_lines_(elements,var,wkt,wkb,area):
+    "CSV lines of as_tabular for GeoJson-like elements."
+    stamps = {}
+    for ii,element in enumerate(elements):
+        geom = element['geometry']
+        properties = element['properties']
+        timestamp = properties['timestamp']
+        if timestamp not in stamps:
+            stamps[timestamp] = timestamp.strftime("%Y-%m-%d %H:%M:%S")
+        #id, timestamp, variable, level if the dataset has levels and area
+        fields = [repr(ii+1),stamps[timestamp],repr(properties[var])]
+        if 'level' in properties:
+            fields.append(repr(properties['level']))
+        fields.append(repr(area(geom)))
+        #optional geometry
+        if wkb:
+            fields.append(repr(geom.wkb))
+        if wkt:
+            fields.append(repr(geom.wkt))
+        yield(','.join(fields)+'\n')
 
-    return path
+def _table_lines_(table,wkt,wkb,area):
+    """
+    CSV lines of as_tabular for an ElementTable. The columns are formatted
+    once per cell and time step and the rows are taken from the long format
+    arrays.
+    """
+    if table is None:
+        return
+    cells,times,levels,values = table.long_format()
+    stamps = [t.strftime("%Y-%m-%d %H:%M:%S") for t in table.timestamps]
+    ## the trailing columns of each cell
+    tails = []
+    for ii in xrange(len(table.cells)):
+        geom = table.geometry(ii)
+        tail = [repr(area(geom))]
+        if wkb:
+            tail.append(repr(geom.wkb))
+        if wkt:
+            tail.append(repr(geom.wkt))
+        tails.append(','.join(tail))
+    if levels is not None:
+        lvls = [repr(l) for l in table.levels]
+    for row,(ii,tt,value) in enumerate(zip(cells.tolist(),times.tolist(),values.tolist())):
+        if levels is None:
+            yield('%d,%s,%r,%s\n' % (row+1,stamps[tt],value,tails[ii]))
+        else:
+            yield('%d,%s,%r,%s,%s\n' % (row+1,stamps[tt],value,lvls[levels[row]],tails[ii]))
 
-def as_keyTabular(elements,var,wkt=False,wkb=False,path = None):
+def as_keyTabular(elements,var,wkt=False,wkb=False,path = None,block=100000):
     '''writes output as tabular csv files, but uses foreign keys
-on time and geometry to reduce file size'''
-    import osgeo.ogr as ogr
+on time and geometry to reduce file size. elements can be any iterable of
+elements or an ElementTable.
+
+data rows are written in time order in blocks of block rows and each geometry
+is written once when it first appears. time keys follow the time axis and
+geometry keys the order in which the geometries first appear. the rows of an
+ElementTable are streamed from its value arrays one time step at a time. the
+keys of other elements are kept in compact arrays to be sorted by time.'''
 
     if path is None:
         path = get_temp_path(suffix='')
@@ -727,103 +1046,172 @@ on time and geometry to reduce file size'''
     pathg = path+"_geometry.txt"
     pathd = path+"_data.txt"
 
-    #define spatial references for the projection
-    sr = ogr.osr.SpatialReference()
-    sr.ImportFromEPSG(4326)
-    sr2 = ogr.osr.SpatialReference()
-    sr2.ImportFromEPSG(3005)
-    data = {}
-
-    #sort the data into dictionaries so common times and geometries can be identified
-    for ii,element in enumerate(elements):
-
-        #record new element ids (otherwise threads will produce copies of ids)
-        element['id']=ii
-
-        #get the time and geometry
-        time = element['properties']['timestamp'].strftime("%Y-%m-%d %H:%M:%S")
-        ewkt = element['geometry'].wkt
-
-        if not (time in data):
-            data[time] = {}
-
-        #put the data into the dictionary
-        if not (ewkt in data[time]):
-            data[time][ewkt] = [element]
-        else:
-            data[time][ewkt].append(element)
-
-
-    #get a unique set of geometry keys
-    locs = []
+    if isinstance(elements,ElementTable) or elements is None:
+        levels = elements is not None and elements.levels is not None
+    else:
+        first,elements = _peek_(elements)
+        levels = first is not None and 'level' in first['properties'].keys()
 
-    for key in data:
-        locs.extend(data[key].keys())
+    #the timestamps in time order and the data lines
+    if isinstance(elements,ElementTable) or elements is None:
+        keys = lambda gkey: _table_key_lines_(elements,gkey)
+    else:
+        keys = lambda gkey: _element_key_lines_(elements,var,gkey,block)
 
-    locs = set(locs)
+    with open(pathg,'w') as fg:
+        fgheader = ['gid','area']
+        if wkt:
+            fgheader += ['wkt']
+        if wkb:
+            fgheader += ['wkb']
+        fg.write(','.join(fgheader))
+        fg.write('\n')
+
+        with open(pathd,'w') as fd:
+            fdheader = ['id','tid','gid',var]
+            if levels:
+                fdheader += ['level']
+            fd.write(','.join(fdheader))
+            fd.write('\n')
+
+            #write out id, foreign keys (time then geometry), the variable
+            #value and the level if appropriate
+            gkey = _geometry_keys_(fg,wkt,wkb,block)
+            stamps,lines = keys(gkey)
+            _write_blocks_(fd,lines,block)
+            gkey(None)
+
+    with open(patht,'w') as ft:
+        ft.write(','.join(['tid','timestamp']))
+        ft.write('\n')
+        ft.writelines('%d,%s\n' % (tid+1,t.strftime("%Y-%m-%d %H:%M:%S")) for tid,t in enumerate(stamps))
+
+def _geometry_keys_(fg,wkt,wkb,block):
+    """
+    Return a function giving the as_keyTabular key of a geometry. The id,
+    area and optional geometry of each new geometry are written to fg in
+    blocks of block rows. Equal geometries of different objects are matched
+    by a digest of their wkb so the geometries are not kept. Call the
+    function with None to write the remaining rows.
+    """
+    area = _area_cache_(keep=False)
+    ## wkb digest -> geometry key
+    keys = {}
+    lines = []
+    def _key(geom):
+        if geom is None or len(lines) >= block:
+            fg.write(''.join(lines))
+            del lines[:]
+        if geom is None:
+            return
+        data = geom.wkb
+        digest = hashlib.sha1(data).digest()
+        if digest not in keys:
+            keys[digest] = len(keys)+1
+            fields = [repr(keys[digest]),repr(area(geom))]
+            if wkt:
+                fields.append(geom.wkt)
+            if wkb:
+                fields.append(repr(ogr.CreateGeometryFromWkb(data).ExportToWkb()))
+            lines.append(','.join(fields)+'\n')
+        return(keys[digest])
+    return(_key)
 
-    ft = open(patht,'w')
-    fg = open(pathg,'w')
-    fd = open(pathd,'w')
-    
-    ft.write(','.join(['tid','timestamp']))
-    ft.write('\n')
+def _element_key_lines_(elements,var,gkey,block):
+    """
+    Time keys and CSV data lines of as_keyTabular for GeoJson-like elements.
+    The time key, geometry key, value and level of every element are kept in
+    compact arrays so the rows can be written in time order. Geometry
+    objects are keyed once within each block of block elements.
     
-    fgheader = ['gid','area']
+    gkey -- function from _geometry_keys_
     
-    if wkt:
-        fgheader += ['wkt']
-    if wkb:
-        fgheader += ['wkb']
+    Returns the timestamps in time order and an iterator over the data lines.
+    """
+    ## timestamp -> index in order of first appearance
+    times = {}
+    ## level repr -> index
+    lkeys = {}
+    tids = array('l')
+    gids = array('l')
+    lids = array('l')
+    values = array('d')
+    ## id of the geometry object -> (geometry,key). the geometry is kept so
+    ## its id is not reused.
+    seen = {}
+    for ii,element in enumerate(elements):
+        if ii % block == 0:
+            seen.clear()
+        geom = element['geometry']
+        properties = element['properties']
+        if id(geom) not in seen:
+            seen[id(geom)] = (geom,gkey(geom))
+        tids.append(times.setdefault(properties['timestamp'],len(times)))
+        gids.append(seen[id(geom)][1])
+        values.append(properties[var])
+        if 'level' in properties:
+            lids.append(lkeys.setdefault(repr(properties['level']),len(lkeys)))
+    seen.clear()
+    stamps = sorted(times)
+    ## time key of each index of first appearance
+    rank = np.empty(len(stamps),dtype=int)
+    rank[[times[t] for t in stamps]] = np.arange(1,len(stamps)+1)
+    tids = rank[np.frombuffer(tids,dtype=np.int_)] if len(tids) > 0 else rank[:0]
+    lvls = sorted(lkeys,key=lkeys.get)
+    def _lines():
+        for row in np.argsort(tids,kind='mergesort').tolist():
+            if len(lids) > 0:
+                yield('%d,%d,%d,%r,%s\n' % (row,tids[row],gids[row],values[row],lvls[lids[row]]))
+            else:
+                yield('%d,%d,%d,%r\n' % (row,tids[row],gids[row],values[row]))
+    return(stamps,_lines())
 
-    fg.write(','.join(fgheader))
-    fg.write('\n')
-    
-    fdheader = ['id','tid','gid',var]
-    if 'level' in elements[0]['properties']:
-        fdheader += ['level']
-        
-    fd.write(','.join(fdheader))
-    fd.write('\n')
-
-    #write the features to file
-    for ii,time in enumerate(data.keys()):
-
-        #write out id's and time values to the time file
-        tdat = data[time]
-        ft.write(repr(ii+1)+','+time+'\n')
-
-        for jj,loc in enumerate(locs):
-            if ii==0:
-
-                #find the geometry area
-                geo = ogr.CreateGeometryFromWkt(loc)
-                geo.AssignSpatialReference(sr)
-                geo.TransformTo(sr2)
-
-                #write the id and area
-                fg.write(repr(jj+1))
-                fg.write(','+repr(geo.GetArea()))
-
-                #write out optional geometry
-                if wkt:
-                    fg.write(','+loc)
-                if wkb:
-                    fg.write(','+repr(ogr.CreateGeometryFromWkt(loc).ExportToWkb()))
-                fg.write('\n')
-
-            if loc in tdat:
-                for element in tdat[loc]:
-                    #write out id, foreign keys (time then geometry) and the variable value
-                    fd.write(','.join([repr(element['id']),repr(ii+1),repr(jj+1),repr(element['properties'][var])]))
-                    #write out level if appropriate
-                    if 'level' in element['properties']:
-                        fd.write(','+repr(element['properties']['level']))
-                    fd.write('\n')
-
-    ft.close()
-    fg.close()
-    fd.close()
+def _table_key_lines_(table,gkey):
+    """
+    Time keys and CSV data lines of as_keyTabular for an ElementTable. The
+    geometries of the cells with values are keyed in cell order and the rows
+    of each time step are taken from the value arrays in time order. Row ids
+    are the rows of the long format arrays. See _element_key_lines_.
+    """
+    if table is None:
+        return([],iter([]))
+    ntime,ncell = len(table.timestamps),len(table.cells)
+    values = table.values.reshape(ntime,ncell,-1)
+    valid = lambda tt: np.invert(np.ma.getmaskarray(values[tt]))
+    order = np.argsort(table.timestamps,kind='mergesort')
+    ## number of values of each cell before each time step in table order.
+    ## only kept if the time steps are not in time order.
+    counts = np.zeros(ncell,dtype=int)
+    before = None if np.all(np.diff(order) > 0) else []
+    for tt in xrange(ntime):
+        if before is not None:
+            before.append(counts.copy())
+        counts += valid(tt).sum(axis=1)
+    ## id of the first row of each cell
+    offsets = np.cumsum(counts)-counts
+    gids = np.zeros(ncell,dtype=int)
+    for ii in np.nonzero(counts)[0].tolist():
+        gids[ii] = gkey(table.geometry(ii))
+    stamps = [table.timestamps[tt] for tt in order.tolist()]
+    if table.levels is not None:
+        lvls = [repr(l) for l in table.levels]
+    def _lines():
+        ## number of values of each cell already written
+        seen = np.zeros(ncell,dtype=int)
+        for tid,tt in enumerate(order.tolist()):
+            mask = valid(tt)
+            cells,levels = np.nonzero(mask)
+            ## position of each value among the values of its cell
+            pos = np.arange(len(cells))-np.searchsorted(cells,cells)
+            rows = offsets[cells]+(seen if before is None else before[tt])[cells]+pos
+            seen += mask.sum(axis=1)
+            data = np.ma.getdata(values[tt])[cells,levels]
+            for row,ii,value,ll in zip(rows.tolist(),cells.tolist(),data.tolist(),levels.tolist()):
+                if table.levels is None:
+                    yield('%d,%d,%d,%r\n' % (row,tid+1,gids[ii],value))
+                else:
+                    yield('%d,%d,%d,%r,%s\n' % (row,tid+1,gids[ii],value,lvls[ll]))
+    return(stamps,_lines())
 
             
 
@@ -841,15 +1229,139 @@ on time and geometry to reduce file size'''
 #'__swig_getmethods__', '__swig_setmethods__', '__weakref__', 'next', 'this']
 
 
-def multipolygon_multicore_operation(dataset,var,polygons,time_range=None,clip=None,dissolve=None,levels = None,ocgOpts=None,subdivide=False,subres='detect',verbose=1,maxProc=0):
+def multipolygon_multicore_operation(dataset,var,polygons,time_range=None,clip=None,dissolve=None,levels = None,ocgOpts=None,subdivide=False,subres='detect',verbose=1,maxProc=0,readPlan=True,columnar=False):
+    """
+    Extract the elements of many polygons with a pool of worker processes.
+    Each worker opens the dataset once and processes tasks carrying a polygon
+    as WKB and the extraction options.
+    
+    maxProc=0 -- number of worker processes. the number of cpus if 0.
+    readPlan=True -- set to False to let each worker read its own data
+        instead of reading planned blocks in a single reader process. reads
+        are only planned if the blocks fit in READ_PLAN_BYTES.
+    columnar=False -- set to True to return the ElementTable of an
+        extraction without a dissolve instead of a list of elements. None if
+        nothing was extracted.
+    """
 
     elements = []
-    ret = []
-    q = Queue()
-    l = Lock()
-    pl = []
-    pcount = 0
-    pcur = 0
+
+    ncp,tasks,collector,pool,planner = _submit_tasks_(dataset,var,polygons,time_range,clip,dissolve,levels,
+                                                      ocgOpts,subdivide,subres,verbose,maxProc,readPlan)
+
+    #wait for the last task. the idle workers are not waited for.
+    finished = False
+    try:
+        collector.wait()
+        finished = True
+    finally:
+        _close_pool_(ncp,pool,planner,finished,collector.prefix)
+
+    #The subdivided geometry must be recombined into the original polygons
+    if dissolve:
+        #groups of elements based on which polygon they belong to
+        groups = collector.groups
+        
+        #for each group, recombine the geometry and average the data points.
+        #each cell was dissolved by the one task owning it.
+        for x in groups.keys():
+            elements.extend(_dissolve_group_(groups[x],var,levels))
+    #handle recombining undissolved features. cells extracted by several
+    #tasks are kept once.
+    else:
+        table = ElementTable.merge(collector.tables,clip)
+        if columnar:
+            return(table)
+                        
+    #multi-level data is expanded to one element per level on the value arrays
+    dtime = time.time()
+    if not dissolve:
+        elements2 = []
+        if table is not None:
+            elements2 = list(table.iter_elements())
+    else:
+        elements2 = elements
+    if verbose>1: print "expansion time: ",time.time()-dtime
+    if verbose>1: print "points: ",repr(len(elements2))
+    return(elements2)
+
+def multipolygon_multicore_iter(dataset,var,polygons,time_range=None,clip=None,dissolve=None,levels = None,ocgOpts=None,subdivide=False,subres='detect',verbose=1,maxProc=0,readPlan=True,columnar=False):
+    """
+    Generator version of multipolygon_multicore_operation yielding the
+    elements of each polygon as a list as soon as all of its tasks finished.
+    Only the results of unfinished polygons are held in memory. Writers take
+    the elements of all chunks with itertools.chain.from_iterable.
+    
+    Without a dissolve, cells extracted for several polygons are kept once.
+    Clipped cells partially covered by a polygon may be fragments of a cell
+    shared with another polygon and are yielded in a last chunk once every
+    polygon finished.
+    
+    columnar=False -- set to True to yield ElementTables instead of lists
+        when there is no dissolve
+    
+    See multipolygon_multicore_operation for the other arguments.
+    """
+    ncp,tasks,collector,pool,planner = _submit_tasks_(dataset,var,polygons,time_range,clip,dissolve,levels,
+                                                      ocgOpts,subdivide,subres,verbose,maxProc,readPlan,stream=True)
+    finished = False
+    try:
+        #number of unfinished tasks and results of each polygon
+        pending = {}
+        for ii,poly in tasks:
+            pending[ii] = pending.get(ii,0)+1
+        results = dict((ii,[]) for ii in pending)
+        #unclipped cells already yielded and clipped cells held back
+        seen = set()
+        held = []
+        ids = 1
+        for count in xrange(len(tasks)):
+            idx,result = collector.get()
+            ii = tasks[idx][0]
+            if result is not None:
+                results[ii].append(result[1] if dissolve else result)
+            pending[ii] -= 1
+            if pending[ii] > 0:
+                continue
+            #the polygon is final
+            group = results.pop(ii)
+            if dissolve:
+                chunk = _dissolve_group_(group,var,levels)
+                if len(chunk) > 0:
+                    yield(chunk)
+                continue
+            table = ElementTable.merge(group,clip)
+            if table is None:
+                continue
+            if clip:
+                held.append(table.take(np.nonzero(table.shared)[0]))
+                table = table.take(np.nonzero(np.invert(table.shared))[0])
+            else:
+                new = np.array([c not in seen for c in table.cells],dtype=bool)
+                seen.update(table.cells.tolist())
+                table = table.take(np.nonzero(new)[0])
+            if len(table.cells) > 0:
+                yield(table if columnar else list(table.iter_elements(ids)))
+                ids += len(table)
+        if len(held) > 0:
+            table = ElementTable.merge(held,clip)
+            if len(table.cells) > 0:
+                yield(table if columnar else list(table.iter_elements(ids)))
+        finished = True
+    finally:
+        #also reached when the consumer stops early
+        _close_pool_(ncp,pool,planner,finished,collector.prefix)
+
+def _submit_tasks_(dataset,var,polygons,time_range,clip,dissolve,levels,ocgOpts,subdivide,subres,verbose,maxProc,readPlan,stream=False):
+    """
+    Partition the polygons into tasks and submit them to a new pool of
+    workers.
+    
+    Returns the dataset, the list of (polygon index,polygon) tasks, the
+    _ResultCollector receiving the results, the pool and the read planner or
+    None.
+    """
+    tasks = []
 
     #set the file reset option if the file is local
     if not('http:' in dataset or 'www.' in dataset):
@@ -863,6 +1375,19 @@ def multipolygon_multicore_operation(dataset,var,polygons,time_range=None,clip=N
     if polygons == [None]:
         polygons = [Polygon(((ncp.col_bnds.min(),ncp.row_bnds.min()),(ncp.col_bnds.max(),ncp.row_bnds.min()),(ncp.col_bnds.max(),ncp.row_bnds.max()),(ncp.col_bnds.min(),ncp.row_bnds.max())))]
 
+    #the number of tasks of each polygon follows its share of the total cost
+    #when subdividing with subres='detect'. cheap polygons are packed into
+    #shared pool calls below.
+    detect = subdivide and subres == 'detect'
+    if detect:
+        ncp._set_time_(time_range)
+        nvalues = len(ncp._idxtime)*(len(levels) if levels else 1)
+        costs = [partition_cost(ncp,p,nvalues) if p.is_valid else 0.0 for p in polygons]
+        target = max(sum(costs),1e-12)/(maxProc or cpu_count())
+        ntiles = [max(1,int(round(c/target))) for c in costs]
+    #estimated cost of each task
+    tcosts = []
+
     for ii,polygon in enumerate(polygons):
         if verbose>1: print(ii)
 
@@ -878,207 +1403,401 @@ def multipolygon_multicore_operation(dataset,var,polygons,time_range=None,clip=N
             #figure out the resolution and subdivide
             #default value uses sqrt(polygon envelop area)
             #generally resulting in 4-6 threads per polygon
+            #the pieces follow cell boundaries so each cell is owned by one task
             if subres == 'detect':
-                subpolys = make_shapely_grid(polygon,sqrt(polygon.envelope.area)/2.0,clip=True)
+                subpolys = partition_polygon(ncp,polygon,ntiles[ii],nvalues)
             else:
-                subpolys = make_shapely_grid(polygon,subres,clip=True)
-            #generate threads for each subpolygon
-
-#            subpolys = [subpolys[1]] ## tdk
+                subpolys = grid_partition(ncp,polygon,subres)
+            #generate tasks for each subpolygon
             for poly in subpolys:
                 ## during regular gridding used to create sub-polygons, a polygon
                 ## may not intersect the actual extraction extent returning None
                 ## in the process as opposed to a Polygon. skip the Nones.
                 if poly is None: continue
-                ## continue generating threads
-                if clip is False:
-                    poly2 = poly.intersection(polygon.envelope)
-                    if poly2 is None: continue
-                
-                ## tdk #####################
-#                ipdb.set_trace()
-#                ncp.extract_elements(q,var,lock=l,polygon=poly,time_range=time_range,clip=clip,dissolve=dissolve,levels=levels,parentPoly=11)
-                ############################
-                ncpp = OcgDataset(dataset,**ocgOpts)
-                p = Process(target = ncpp.extract_elements,
-                                args =       (q,
-                                                var,),
-                                kwargs= {
-                                                'lock':l,
-                                                'polygon':poly,
-                                                'time_range':time_range,
-                                                'clip':clip,
-                                                'dissolve':dissolve,
-                                                'levels' : levels,
-                                                'parentPoly':ii})
-                pl.append(p)
-
-        #if no polygons are specified only 1 thread will be created per polygon
+                ## continue generating tasks
+                tasks.append((ii,poly))
+                if detect:
+                    tcosts.append(costs[ii]/len(subpolys))
+
+        #if no polygons are specified only 1 task will be created per polygon
         else:
-            ncpp = OcgDataset(dataset,**ocgOpts)
-            p = Process(target = ncpp.extract_elements,
-                            args =       (
-                                            q,
-                                            var,),
-                            kwargs= {
-                                            'lock':l,
-                                            'polygon':polygon,
-                                            'time_range':time_range,
-                                            'clip':clip,
-                                            'dissolve':dissolve,
-                                            'levels' : levels,
-                                            'parentPoly':ii})
-            pl.append(p)
-
-    #for p in pl:
-        #p.join()
-
-    #consumer loop, the main process will grab any feature lists added by the
-    #processing threads and continues until those threads have terminated.
-    #without this the processing threads will NOT terminate
-    a=True
-    while a:
-        #count active processes
-        pcount = 0
-        for p in pl:
-            if p.is_alive():
-                pcount +=1
-                
-        #if unstarted processes remain and we are under the limit, start more
-        if pcur < len(pl) and (pcount<maxProc or maxProc == 0):
-            while(pcount<maxProc or (maxProc==0 and pcur<len(pl))):
-                pl[pcur].start()
-                pcur += 1
-                pcount += 1
-            
-        #once all the processes have been started start checking if we have finished.
-        if pcur == len(pl):
-            a=False
-            #check if any threads are still active
-            for p in pl:
-                a = a or p.is_alive()
+            tasks.append((ii,polygon))
+
+    #with fewer tasks than workers the time axis of small windows is split
+    #into blocks. the overlay is computed once and shared by the blocks.
+    nworkers = maxProc or cpu_count()
+    ncp._set_time_(time_range)
+    ntime = len(ncp._idxtime)
+    nblocks = 1
+    if 0 < len(tasks) < nworkers:
+        nblocks = max(1,min(int(ceil(nworkers/float(len(tasks)))),ntime//MIN_TIME_BLOCK))
+    jobs = []
+    for idx,(ii,poly) in enumerate(tasks):
+        overlay = None
+        time_blocks = [None]
+        r0,r1,c0,c1 = ncp._window_(poly)
+        if nblocks > 1 and (r1-r0)*(c1-c0) <= TIME_SPLIT_CELLS:
+            ncp._set_spatial_(polygon=poly,clip=clip)
+            overlay = ncp._dump_overlay_()
+            edges = np.linspace(0,ntime,nblocks+1).astype(int)
+            time_blocks = zip(edges[:-1],edges[1:])
+        for jj,time_block in enumerate(time_blocks):
+            jobs.append((idx,ii,poly,time_block,overlay,jj,len(time_blocks)))
+
+    #jobs run in batches of one pool call each
+    if detect:
+        batches = pack_tasks([tcosts[job[0]]/job[6] for job in jobs],target)
+    else:
+        batches = [[bidx] for bidx in xrange(len(jobs))]
+
+    #read the data for all tasks at once so shared chunks are decoded once.
+    #the blocks are handed to the workers when the pool is created.
+    #one file lock is shared by the reads of this extraction
+    lock = Lock()
+    planner = None
+    blocks = [None]*len(jobs)
+    if readPlan:
+        planner = plan_reads(ncp,var,[job[2] for job in jobs],time_range=time_range,levels=levels,
+                             lock=lock,time_blocks=[job[3] for job in jobs])
+        if planner is not None:
+            blocks = planner.blocks
+
+    #tasks only carry the polygon and the extraction options. results are
+    #merged by a callback as each task completes.
+    collector = _ResultCollector(len(jobs),dissolve,ncp.cell_geometry,stream)
+    #results passed through shared memory are named after the extraction so
+    #the ones never received can be removed when the pool is closed
+    collector.prefix = SHARED_PREFIX%os.getpid()+'%d-'%_extraction_ids.next()
+    #no more workers than batches are started
+    pool = Pool(processes=max(1,min(nworkers,len(batches))),
+                initializer=_init_worker_,
+                initargs=(dataset,ocgOpts,blocks,lock))
+    collector.workers = list(pool._pool)
+    for batch in batches:
+        items = []
+        callbacks = []
+        for bidx in batch:
+            idx,ii,poly,time_block,overlay,jj,njj = jobs[bidx]
+            options = dict(var=var,
+                           time_range=time_range,
+                           clip=clip,
+                           dissolve=dissolve,
+                           levels=levels,
+                           parentPoly=ii,
+                           block=bidx,
+                           prefix=collector.prefix)
+            if time_block is not None:
+                options.update(time_block=time_block,overlay=overlay)
+            items.append((poly.wkb,options))
+            callbacks.append(collector.callback(idx,jj,njj))
+        pool.apply_async(_extract_tasks_,(items,),callback=collector.batch_callback(callbacks))
+    pool.close()
+
+    return(ncp,tasks,collector,pool,planner)
+
+## numbers the extractions of a process
+_extraction_ids = itertools.count()
+
+def _close_pool_(ncp,pool,planner,finished,prefix=None):
+    """
+    Stop the workers and the reader of an extraction and close the dataset
+    of the parent. Results keep ncp to build cell geometries and a handle
+    left open would be inherited by the processes of a later extraction of
+    the same file, which then read corrupted data.
+    
+    finished -- False if the extraction was abandoned before every task
+        finished
+    prefix=None -- name prefix of the extraction's shared memory files.
+        files of results that were never received are removed.
+    """
+    pool.terminate()
+    if prefix is not None:
+        remove_shared(prefix)
+    if planner is not None and planner.reader is not None:
+        #all blocks have been consumed once the tasks finished
+        if not finished:
+            planner.reader.terminate()
+        planner.reader.join()
+    ncp.dataset.close()
+
+def _dissolve_group_(group,var,levels):
+    """
+    Combine the dissolved features of the tasks of one polygon into one
+    feature per time step and level.
+    
+    group -- list of the feature lists of each task
+    """
+    elements = []
+    group = [y for y in group if len(y)>0]
+    if len(group) == 0:
+        return(elements)
+
+    #recombine the geometry using the first time period
+    total = cascaded_union([y[0]['geometry'] for y in group])
+
+    #(task,time[,level]) arrays of the values and their weights. the
+    #weights are renormalized at each time step and level.
+    values = np.array([[f['properties'][var] for f in g] for g in group],dtype=float)
+    weights = np.array([[f['weight'] for f in g] for g in group],dtype=float)
+    ta = weights.sum(axis=0)
+    avg = (values*weights).sum(axis=0)/np.where(ta > 0,ta,1)
+
+    #form new features in long format, one per time step and level. time
+    #steps and levels without values are dropped.
+    idx = np.nonzero(ta > 0)
+    values = avg[idx].tolist()
+    for row,t in enumerate(idx[0].tolist()):
+        first = group[0][t]
+        properties = {var:values[row],
+                      'timestamp':first['properties']['timestamp']}
+        if not(levels == None):
+            properties['level'] = first['properties']['levels'][idx[1][row]]
+        elements.append(dict(id=first['id'],geometry=total,properties=properties))
+    return(elements)
 
-        #remove anything from the queue if present
-        while not q.empty():
-            ret.append(q.get())
+## dataset, planned blocks and file lock of a pool worker
+_worker_ocg = None
+_worker_blocks = None
+_worker_lock = None
 
-        #give the threads some time to process more stuff
-        time.sleep(.1)
+def _init_worker_(dataset,ocgOpts,blocks,lock=None):
+    """
+    Open the dataset once per pool worker.
+    
+    lock=None -- multiprocessing Lock shared by the workers of an extraction
+    """
+    global _worker_ocg, _worker_blocks, _worker_lock
+    _worker_ocg = OcgDataset(dataset,**ocgOpts)
+    _worker_blocks = blocks
+    _worker_lock = lock
 
-    #The subdivided geometry must be recombined into the original polygons
-    if dissolve:
-        groups = {}
+def _extract_task_(wkb,options):
+    """
+    Extract the elements of one polygon in a pool worker.
+    
+    wkb -- polygon as WKB
+    options -- extraction options. block is the index of the task's planned
+        block and prefix the name prefix of its shared memory file.
+    
+    Returns the tuple extract_elements puts on its queue, the packed
+    ElementTable without a dissolve, or None if the extraction failed.
+    """
+    ## the callback only fires for a returned result so every failure is
+    ## returned as None
+    try:
+        options = options.copy()
+        _worker_ocg.block = _worker_blocks[options.pop('block')]
+        prefix = options.pop('prefix',None)
+        q = _TaskResult()
+        _worker_ocg.extract_elements(q,options.pop('var'),polygon=load_wkb(wkb),lock=_worker_lock,**options)
+        if isinstance(q.value,ElementTable):
+            return(q.value.pack(prefix=prefix))
+        return(q.value)
+    except Exception:
+        ## a failed task drops its elements as a failed process did
+        traceback.print_exc()
+        return(None)
+
+def _extract_tasks_(items):
+    """
+    Extract a batch of tasks in one pool call.
+    
+    items -- list of the (wkb,options) arguments of _extract_task_
+    
+    Returns the list of the results of _extract_task_.
+    """
+    return([_extract_task_(wkb,options) for wkb,options in items])
 
-        #form groups of elements based on which polygon they belong to
-        for x in ret:
-            if not x[0] in groups:
-                groups[x[0]] = []
+class _TaskResult(object):
+    "Stands in for the queue extract_elements puts its result on."
+    value = None
+    def put(self,value):
+        self.value = value
 
-            groups[x[0]].append((x[1],x[2]))
-        #print '>',groups.keys()
-        #print groups
+class _ResultCollector(object):
+    """
+    Merges task results as they arrive through the pool's callbacks. The
+    results of a task split along the time axis are concatenated in time
+    order once all of its blocks arrived.
+    
+    count -- number of tasks
+    dissolve -- True if the tasks dissolve their elements
+    cell_geometry=None -- function returning the box geometry of a cell index
+        used by the unpacked element tables
+    stream=False -- set to True to put (task,result) on the queue as each
+        task completes instead of keeping the results. failed tasks give a
+        None result.
+    
+    workers holds the processes of the pool. Results of a task whose worker
+    died never arrive so waiting raises a RuntimeError once one of them
+    exited.
+    prefix names the shared memory files of the extraction's results.
+    """
+    
+    def __init__(self,count,dissolve,cell_geometry=None,stream=False):
+        self.remaining = count
+        self.dissolve = dissolve
+        self.cell_geometry = cell_geometry
+        self.queue = Queue.Queue() if stream else None
+        ## polygon index -> list of feature lists for a dissolve
+        self.groups = {}
+        ## element tables of the tasks without a dissolve
+        self.tables = []
+        ## results of the time blocks of split tasks
+        self.parts = {}
+        self.done = threading.Event()
+        self.workers = []
+        self.prefix = None
+        if count == 0:
+            self.done.set()
         
-        #for each group, recombine the geometry and average the data points
-        for x in groups.keys():
-
-            #for y in groups[x]:
-                #print len(y[0])
-            group = [y[0] for y in groups[x] if len(y[0])>0]
-
-            #print groups[x][0][1]
-            recombine ={}
-            for y in groups[x]:
-                recombine.update(y[1])
-
-            for key in recombine.keys():
-                group.append(recombine[key])
-
-            #recombine the geometry using the first time period
-            total = cascaded_union([y[0]['geometry'] for y in group])
-
-            #form subgroups consisting of subpolygons that cover the same time period
-            subgroups = [[g[t] for g in group] for t in xrange(len(group[0]))]
-
-            ta = sum([y['weight'] for y in subgroups[0]])
-            #print 't',ta
-
-            #average the data values and form new features
-            for subgroup in subgroups:
-                if not(levels == None):
-                    avg = [sum([y['properties'][var][z]*(y['weight']/ta) for y in subgroup]) for z in xrange(len(levels))]
-                    elements.append(    dict(
-                                        id=subgroup[0]['id'],
-                                        geometry=total,
-                                        properties=dict({VAR: avg,
-                                                        'timestamp':subgroup[0]['properties']['timestamp'],
-                                                        'level': subgroup[0]['properties']['levels']})))
-                    #print total.area
-                    #print avg
-                else:
-                    #print (y['weight']/ta)
-                    avg = sum([y['properties'][var]*(y['weight']/ta) for y in subgroup])
-                    elements.append(    dict(
-                                        id=subgroup[0]['id'],
-                                        geometry=total,
-                                        properties=dict({var:float(avg),
-                                                        'timestamp':subgroup[0]['properties']['timestamp']})))
-    #handle recombining undissolved features
-    else:
-        recombine = []
-        #pull out unique elements and potentially repeated elements
-        for x in ret:
-            elements.extend(x[0])
-            recombine.append(x[1])
-
-        #get a list of all unique locations
-        keylist = []
-        for x in recombine:
-            keylist.extend(x.keys())
-        keylist = set(keylist)
-
-        #find all the locations that have duplicated features
-        for key in keylist:
-            cur = []
-            for x in recombine:
-                if key in x:
-                    cur.append(x[key])
-            #print cur
-
-            #if there is only 1 feature, it is unique so toss it into the element list
-            if len(cur)==1:
-                elements.extend(cur[0])
+    def callback(self,task,block,nblocks):
+        "Callback receiving the result of one time block of a task."
+        def _add(result):
+            try:
+                try:
+                    result = self._unpack_(result)
+                except Exception:
+                    #an exception would stop the pool's result handler
+                    traceback.print_exc()
+                    result = None
+                parts = self.parts.setdefault(task,[])
+                parts.append((block,result))
+                if len(parts) == nblocks:
+                    parts = [p for b,p in sorted(self.parts.pop(task))]
+                    #a task with a failed block is dropped
+                    if any(p is None for p in parts):
+                        result = None
+                    elif nblocks == 1:
+                        result = parts[0]
+                    else:
+                        result = self._concatenate_(parts)
+                    self._merge_(task,result)
+            finally:
+                self._finish_()
+        return(_add)
+        
+    def batch_callback(self,callbacks):
+        "Callback passing the results of a batch to the callbacks of its blocks."
+        def _add(results):
+            for callback,result in zip(callbacks,results):
+                callback(result)
+        return(_add)
+        
+    def add(self,result,task=None):
+        "Merge the result of one task."
+        self.callback(task,0,1)(result)
+
+    def _unpack_(self,result):
+        "Rebuild the element table of a packed result."
+        if isinstance(result,dict):
+            return(ElementTable.unpack(result,self.cell_geometry))
+        return(result)
+                
+    def _merge_(self,task,result):
+        if self.queue is not None:
+            self.queue.put((task,result))
+        elif result is None:
+            pass
+        elif self.dissolve:
+            self.groups.setdefault(result[0],[]).append(result[1])
+        else:
+            self.tables.append(result)
+                
+    def _finish_(self):
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.done.set()
             
-            else:
-                #if clip=False then all the features are identical, pick one and discard the rest
-                if not clip:
-                    elements.extend(cur[0])
-                #if clip=True then the features have the same values but the geometry is fragmented
-                else:
-                    #recombine the geometry
-                    geo = cascaded_union([x[0]['geometry'] for x in cur])
-                    #pick a feature, update the geometry, and discard the rest
-                    for x in cur[0]:
-                        x['geometry'] = geo
-                        elements.append(x)
-                        
-    elements2 = []
+    def _concatenate_(self,parts):
+        "Join the results of consecutive time blocks of a task."
+        if not self.dissolve:
+            return(ElementTable.join_time(parts))
+        features = []
+        for part in parts:
+            features.extend(part[-1])
+        return(parts[0][0],features)
+                
+    def wait(self):
+        "Block until every task has been merged."
+        while not self.done.wait(WORKER_POLL):
+            self._check_workers_()
 
-    #expand elements in the case of multi-level data
-    dtime = time.time()
-    if not (levels == None):
-        for x in elements:
-            #create a new feature for each data level
-            for i in xrange(len(levels)):
-                e = x.copy()
-                e['properties'] = x['properties'].copy()
-                e['properties'][var] = e['properties'][var][i]
-                e['properties']['level'] = e['properties']['level'][i]
-                elements2.append(e)
+    def get(self):
+        "Return the next (task,result) of a streaming collector."
+        while True:
+            try:
+                return(self.queue.get(timeout=WORKER_POLL))
+            except Queue.Empty:
+                self._check_workers_()
+
+    def _check_workers_(self):
+        if any(w.exitcode is not None for w in self.workers):
+            raise RuntimeError('a pool worker died before its tasks finished')
+
+def plan_reads(ncp,var,polygons,time_range=None,levels=None,lock=None,time_blocks=None,max_bytes=READ_PLAN_BYTES):
+    """
+    Read the data windows of many extraction tasks with a chunk-aware read
+    planner returning the block covering each task's window. Windows are
+    grown to whole chunks and merged so each chunk is decoded once. If the
+    dataset was opened from a uri the blocks are shared-memory buffers filled
+    in task order by a single reader process (the planner's reader) which
+    must be joined once the tasks finish. Otherwise the blocks are read here.
+    
+    ncp -- OcgDataset used to locate the windows
+    var -- NC variable to extract from
+    polygons -- sequence of the tasks' shapely polygon objects
+    lock=None -- multiprocessing Lock guarding the file for reads done here
+    time_blocks=None -- sequence of the tasks' (start,stop) positions within
+        the selected time indices or None for the whole selection
+    max_bytes=READ_PLAN_BYTES -- largest size of all blocks
+    
+    Returns the ReadPlanner holding the chunk statistics and, in its blocks
+    attribute, the block of each task. None if there is nothing to read or
+    the blocks would be larger than max_bytes.
+    """
+    variable = ncp.dataset.variables[var]
+    ncp._set_time_(time_range)
+    if len(ncp._idxtime) == 0:
+        return(None)
+    windows = []
+    for ii,polygon in enumerate(polygons):
+        idxtime = ncp._idxtime
+        if time_blocks is not None and time_blocks[ii] is not None:
+            idxtime = idxtime[time_blocks[ii][0]:time_blocks[ii][1]]
+        r0,r1,c0,c1 = ncp._window_(polygon)
+        window = [(int(idxtime.min()),int(idxtime.max())+1),(r0,r1),(c0,c1)]
+        if len(variable.dimensions) == 4:
+            if not levels:
+                windows.append(None)
+                continue
+            window.insert(1,(min(levels),max(levels)+1))
+        windows.append(window)
+    planner = ReadPlanner(variable)
+    nbytes = planner.nbytes(planner.plan(windows)[0])
+    if nbytes > max_bytes:
+        if ncp.verbose>1: print "read plan of "+repr(nbytes)+" bytes skipped"
+        return(None)
+    if ncp.uri is not None:
+        planner.schedule(windows,ncp.uri,var)
     else:
-        elements2 = elements
-    if verbose>1: print "expansion time: ",time.time()-dtime
-    if verbose>1: print "points: ",repr(len(elements2))
-    return(elements2)
+        planner.read(windows,lock=lock)
+    if ncp.verbose>1:
+        print "chunks touched: ",planner.chunks_touched
+        print "chunks decoded: ",planner.chunks_decoded
+    return(planner)
+
+def multipolygon_zonal_operation(dataset,var,polygons,time_range=None,levels=None,ocgOpts=None):
+    """
+    Area-weighted means of a variable for many polygons computed in one pass
+    with a sparse weight matrix. Suited to dissolving thousands of polygons.
+    
+    Returns the timestamps and a masked (polygon,time) ndarray or (polygon,
+    time,level) ndarray for 4-d variables.
+    """
+    ncp = OcgDataset(dataset,**(ocgOpts or {}))
+    values = ncp.zonal_means(var,polygons,time_range=time_range,levels=levels)
+    return(ncp._timestamps,values)
 
 def multipolygon_singlecore_operation(uri,var,polygons,time_range,clip=False,dissolve=False,levels=None,ocgOpts={}):
     ## open the connection to the dataset object
@@ -1147,6 +1866,378 @@ def make_shapely_grid(poly,res,as_numpy=False,clip=True):
     
     return(ret)
 
+
+def partition_cost(ocg,polygon,nvalues):
+    "Estimated cost of extracting a polygon. See cell_costs."
+    r0,c0,cost = cell_costs(ocg,polygon,nvalues)
+    return(float(cost.sum()))
+
+def cell_costs(ocg,polygon,nvalues):
+    """
+    Estimated extraction cost of each cell in the polygon's window. A cell
+    covered by the polygon costs one unit per value read (time steps x
+    levels). Boundary cells add the cost of clipping them proportional to
+    the polygon's vertex count.
+    
+    ocg -- OcgDataset
+    polygon -- shapely polygon object
+    nvalues -- number of values per cell
+    
+    Returns the first row and column of the window and the cost array.
+    """
+    r0,r1,c0,c1 = ocg._window_(polygon)
+    if r1 <= r0 or c1 <= c0:
+        return(r0,c0,np.zeros((0,0)))
+    label = classify_cells(polygon,ocg.col_bnds[c0:c1],ocg.row_bnds[r0:r1])
+    nverts = sum(len(ring.coords) for p in _polygon_parts_(polygon)
+                 for ring in [p.exterior]+list(p.interiors))
+    cost = np.zeros(label.shape)
+    cost[label != CELL_OUTSIDE] = nvalues
+    cost[label == CELL_BOUNDARY] += VERTEX_COST*nverts
+    return(r0,c0,cost)
+
+def split_tiles(cost,ntiles):
+    """
+    Split a cost array into about ntiles rectangular tiles of equal cost by
+    recursively bisecting the most expensive tile at its cost median along
+    its longer side. Tiles are trimmed to their non-zero cells and empty
+    tiles are dropped. A single cell is never split.
+    
+    Returns a list of (first row, last row + 1, first col, last col + 1).
+    
+    >>> split_tiles(np.ones((4,4)),4)
+    [(0, 2, 0, 2), (0, 2, 2, 4), (2, 4, 0, 2), (2, 4, 2, 4)]
+    """
+    def _trim(tile):
+        r0,r1,c0,c1 = tile
+        rr,cc = np.nonzero(cost[r0:r1,c0:c1])
+        if len(rr) == 0:
+            return(None)
+        return((r0+rr.min(),r0+rr.max()+1,c0+cc.min(),c0+cc.max()+1))
+    
+    def _cost(tile):
+        r0,r1,c0,c1 = tile
+        return(cost[r0:r1,c0:c1].sum())
+    
+    first = _trim((0,cost.shape[0],0,cost.shape[1]))
+    if first is None:
+        return([])
+    tiles = [first]
+    while len(tiles) < ntiles:
+        ## the most expensive tile that can be split
+        order = sorted(range(len(tiles)),key=lambda x: -_cost(tiles[x]))
+        order = [x for x in order if tiles[x][1]-tiles[x][0] > 1 or tiles[x][3]-tiles[x][2] > 1]
+        if len(order) == 0:
+            break
+        r0,r1,c0,c1 = tiles.pop(order[0])
+        sub = cost[r0:r1,c0:c1]
+        axis = 1 if c1-c0 > r1-r0 else 0
+        ## split where the cumulative cost along the axis reaches half
+        cs = np.cumsum(sub.sum(axis=1-axis))
+        k = int(np.searchsorted(cs,cs[-1]/2.0))+1
+        k = min(max(k,1),len(cs)-1)
+        if axis == 0:
+            children = [(r0,r0+k,c0,c1),(r0+k,r1,c0,c1)]
+        else:
+            children = [(r0,r1,c0,c0+k),(r0,r1,c0+k,c1)]
+        tiles += [t for t in map(_trim,children) if t is not None]
+    return(sorted(tiles))
+
+def pack_tasks(costs,target):
+    """
+    Group the tasks into batches of about target cost. Tasks are taken by
+    descending cost and added to the first batch they fit in so cheap tasks
+    share a batch. Tasks costing target or more are alone in their batch.
+    
+    costs -- estimated cost of each task
+    target -- cost of a batch
+    
+    Returns a list of lists of task indices.
+    """
+    batches = []
+    loads = []
+    for idx in sorted(xrange(len(costs)),key=lambda x: -costs[x]):
+        for bb,load in enumerate(loads):
+            if load+costs[idx] <= target:
+                batches[bb].append(idx)
+                loads[bb] += costs[idx]
+                break
+        else:
+            batches.append([idx])
+            loads.append(costs[idx])
+    return(batches)
+
+def partition_polygon(ocg,polygon,ntiles,nvalues):
+    """
+    Cut a polygon into about ntiles pieces of equal estimated cost. The
+    pieces are cut along cell boundaries so every cell is extracted by a
+    single task.
+    
+    ocg -- OcgDataset
+    polygon -- shapely polygon object
+    ntiles -- target number of pieces
+    nvalues -- number of values per cell (time steps x levels)
+    
+    Returns a list of shapely polygon objects.
+    """
+    r0,c0,cost = cell_costs(ocg,polygon,nvalues)
+    if ntiles <= 1:
+        return([polygon] if cost.any() else [])
+    ret = []
+    for t0,t1,u0,u1 in split_tiles(cost,ntiles):
+        piece = _cut_tile_(ocg,polygon,ocg.row_bnds[r0+t0:r0+t1],ocg.col_bnds[c0+u0:c0+u1])
+        if piece is not None:
+            ret.append(piece)
+    return(ret)
+
+def grid_partition(ocg,polygon,res):
+    """
+    Cut a polygon into the pieces of a regular grid of resolution res
+    snapped to cell boundaries. Each cell is owned by the grid tile holding
+    its center, so every cell is extracted by a single task and tasks never
+    produce duplicates or fragments of the same cell.
+    
+    ocg -- OcgDataset
+    polygon -- shapely polygon object
+    res -- grid resolution in the units of the dataset's coordinates
+    
+    Returns a list of shapely polygon objects.
+    """
+    r0,r1,c0,c1 = ocg._window_(polygon)
+    if r1 <= r0 or c1 <= c0:
+        return([])
+    rows,cols = ocg.row_bnds[r0:r1],ocg.col_bnds[c0:c1]
+    min_x,min_y,max_x,max_y = polygon.envelope.bounds
+    ## tile of each row and column of cells found from the cell centers.
+    ## centers beyond the envelope belong to the outermost tiles.
+    def _tiles(bnds,lower,upper):
+        edges = np.arange(lower,upper,float(res))
+        if len(edges) == 0:
+            edges = np.array([lower])
+        idx = np.searchsorted(edges,bnds.mean(axis=1),side='right')-1
+        return(np.clip(idx,0,len(edges)-1))
+    trow = _tiles(rows,min_y,max_y)
+    tcol = _tiles(cols,min_x,max_x)
+    ret = []
+    for ty in np.unique(trow):
+        for tx in np.unique(tcol):
+            piece = _cut_tile_(ocg,polygon,rows[trow == ty],cols[tcol == tx])
+            if piece is not None:
+                ret.append(piece)
+    return(ret)
+
+def _cut_tile_(ocg,polygon,rows,cols):
+    "Part of a polygon within the box of the given row and column bounds or None."
+    tile = ocg._make_poly_((rows.min(),rows.max()),(cols.min(),cols.max()))
+    parts = _polygon_parts_(polygon.intersection(tile))
+    if len(parts) == 1:
+        return(parts[0])
+    elif len(parts) > 1:
+        return(MultiPolygon(parts))
+    return(None)
+    
+def cell_overlap_areas(polygon,min_col,min_row,max_col,max_row,chunk=1000000):
+    """
+    Return the area of overlap between a polygon and each axis-aligned cell
+    in one pass over NumPy arrays. Every polygon ring is integrated with the
+    trapezoid rule after clamping its heights to the row bounds of each cell,
+    so no per-cell geometry is constructed.
+    
+    polygon -- shapely Polygon or MultiPolygon
+    min_col,min_row,max_col,max_row -- 1-d ndarrays of cell bounds
+    chunk=1000000 -- maximum number of edge/cell pairs evaluated at once
+    """
+    min_col,min_row,max_col,max_row = [np.asarray(a,dtype=float) for a in
+                                       (min_col,min_row,max_col,max_row)]
+    area = np.zeros(len(min_col))
+    if len(area) == 0:
+        return(area)
+    for part in _polygon_parts_(polygon):
+        for ii,ring in enumerate([part.exterior]+list(part.interiors)):
+            coords = np.asarray(ring.coords,dtype=float)[:,0:2]
+            ring_area = _ring_overlap_areas_(coords,min_col,min_row,max_col,max_row,chunk)
+            ## holes are removed from the exterior
+            if ii == 0:
+                area += ring_area
+            else:
+                area -= ring_area
+    return(np.minimum(np.maximum(area,0.0),(max_col-min_col)*(max_row-min_row)))
+
+def classify_cells(polygon,col_bnds,row_bnds):
+    """
+    Label the cells of a rectilinear grid as CELL_OUTSIDE, CELL_INSIDE or
+    CELL_BOUNDARY with respect to a polygon. Cell corners are tested against
+    the polygon in bulk and every cell touched by a polygon edge is labeled a
+    boundary cell, so the inside and outside labels are exact.
+    
+    polygon -- shapely Polygon or MultiPolygon
+    col_bnds -- (n,2) ndarray of column bounds
+    row_bnds -- (m,2) ndarray of row bounds
+    
+    Returns an (m,n) int8 ndarray.
+    """
+    col_bnds = np.asarray(col_bnds,dtype=float)
+    row_bnds = np.asarray(row_bnds,dtype=float)
+    col_lo,col_hi = col_bnds.min(axis=1),col_bnds.max(axis=1)
+    row_lo,row_hi = row_bnds.min(axis=1),row_bnds.max(axis=1)
+    ncol,nrow = len(col_lo),len(row_lo)
+    x0,y0,x1,y1 = _polygon_edges_(polygon)
+    ## even-odd test of the four corners of every cell
+    inside = _grid_in_polygon_(x0,y0,x1,y1,
+                               np.concatenate((col_lo,col_hi)),
+                               np.concatenate((row_lo,row_hi)))
+    corners = (inside[:nrow,:ncol].astype(int)+inside[:nrow,ncol:]+
+               inside[nrow:,:ncol]+inside[nrow:,ncol:])
+    label = np.empty((nrow,ncol),dtype=np.int8)
+    label[:] = CELL_BOUNDARY
+    label[corners == 4] = CELL_INSIDE
+    label[corners == 0] = CELL_OUTSIDE
+    label[_touched_cells_(x0,y0,x1,y1,col_lo,col_hi,row_lo,row_hi)] = CELL_BOUNDARY
+    return(label)
+
+def _polygon_edges_(polygon):
+    "Start and end coordinates of every ring segment of a polygon."
+    edges = []
+    for part in _polygon_parts_(polygon):
+        for ring in [part.exterior]+list(part.interiors):
+            coords = np.asarray(ring.coords,dtype=float)[:,0:2]
+            edges.append(np.hstack((coords[:-1],coords[1:])))
+    if len(edges) == 0:
+        edges = [np.zeros((0,4))]
+    edges = np.vstack(edges)
+    return(edges[:,0],edges[:,1],edges[:,2],edges[:,3])
+
+def _grid_in_polygon_(x0,y0,x1,y1,xs,ys):
+    "Even-odd test of every (ys[i],xs[j]) point by scanning each row."
+    ret = np.zeros((len(ys),len(xs)),dtype=bool)
+    for ii,y in enumerate(ys):
+        straddle = (y0 <= y) != (y1 <= y)
+        xc = x0[straddle]+(y-y0[straddle])*(x1[straddle]-x0[straddle])/(y1[straddle]-y0[straddle])
+        xc.sort()
+        ## a point is inside if an odd number of edges cross the row to its left
+        ret[ii] = np.searchsorted(xc,xs,side='right')%2 == 1
+    return(ret)
+
+def _touched_cells_(x0,y0,x1,y1,col_lo,col_hi,row_lo,row_hi):
+    """
+    Boolean (row,col) ndarray of the cells whose closed bounds are touched by
+    at least one edge. Only the cells crossed by each edge are visited.
+    """
+    touched = np.zeros((len(row_lo),len(col_lo)),dtype=bool)
+    corder,rorder = np.argsort(col_lo),np.argsort(row_lo)
+    clo,chi = col_lo[corder],col_hi[corder]
+    rlo,rhi = row_lo[rorder],row_hi[rorder]
+    ## columns spanned by each edge
+    xmin,xmax = np.minimum(x0,x1),np.maximum(x0,x1)
+    first = np.searchsorted(chi,xmin,side='left')
+    count = np.maximum(np.searchsorted(clo,xmax,side='right')-first,0)
+    eidx,cpos = _expand_ranges_(first,count)
+    ## portion of each edge within the column and the rows it spans
+    xl = np.maximum(xmin[eidx],clo[cpos])
+    xr = np.minimum(xmax[eidx],chi[cpos])
+    dx = x1[eidx]-x0[eidx]
+    slope = (y1[eidx]-y0[eidx])/np.where(dx == 0,1.0,dx)
+    yl = np.where(dx == 0,y0[eidx],y0[eidx]+(xl-x0[eidx])*slope)
+    yr = np.where(dx == 0,y1[eidx],y0[eidx]+(xr-x0[eidx])*slope)
+    first = np.searchsorted(rhi,np.minimum(yl,yr),side='left')
+    count = np.maximum(np.searchsorted(rlo,np.maximum(yl,yr),side='right')-first,0)
+    pidx,rpos = _expand_ranges_(first,count)
+    touched[rorder[rpos],corder[cpos[pidx]]] = True
+    return(touched)
+
+def _expand_ranges_(first,count):
+    "Expand (first,count) ranges into (range index,position) pairs."
+    idx = np.repeat(np.arange(len(first)),count)
+    offset = np.cumsum(count)-count
+    return(idx,first[idx]+np.arange(len(idx))-offset[idx])
+
+def _as_slice_(idx):
+    "Slice equivalent to a 1-d index array if its values are contiguous."
+    if len(idx) > 0 and idx[-1]-idx[0]+1 == len(idx) and (np.diff(idx) == 1).all():
+        return(slice(int(idx[0]),int(idx[-1])+1))
+    return(idx)
+
+def _level_runs_(levels):
+    """
+    Split a list of level indices into slices of contiguous runs keeping
+    their order.
+    
+    >>> _level_runs_([0,1,2,5,6,3])
+    [slice(0, 3, None), slice(5, 7, None), slice(3, 4, None)]
+    """
+    levels = np.asarray(levels,dtype=int)
+    breaks = np.nonzero(np.diff(levels) != 1)[0]+1
+    return([slice(int(r[0]),int(r[-1])+1) for r in np.split(levels,breaks)])
+
+def rectangle_overlap_areas(bounds,min_col,min_row,max_col,max_row):
+    """
+    Return the area of overlap between an axis-aligned rectangle and each cell
+    using min/max arithmetic on the cell bounds.
+    
+    bounds -- (min col, min row, max col, max row) of the rectangle
+    min_col,min_row,max_col,max_row -- 1-d ndarrays of cell bounds
+    """
+    emin_col,emin_row,emax_col,emax_row = bounds
+    width = np.minimum(max_col,emax_col)-np.maximum(min_col,emin_col)
+    height = np.minimum(max_row,emax_row)-np.maximum(min_row,emin_row)
+    return(np.maximum(width,0.0)*np.maximum(height,0.0))
+
+def is_rectangle(polygon):
+    "True if the polygon is an axis-aligned rectangle."
+    if polygon.geom_type != 'Polygon' or len(polygon.interiors) > 0:
+        return(False)
+    envelope = polygon.envelope
+    return(abs(envelope.area-polygon.area) <= envelope.area*OVERLAY_TOLERANCE)
+
+def _polygon_parts_(geom):
+    "Return the non-empty Polygon parts of a geometry."
+    if geom.is_empty:
+        return([])
+    elif geom.geom_type == 'Polygon':
+        return([geom])
+    elif hasattr(geom,'geoms'):
+        return([p for g in geom.geoms for p in _polygon_parts_(g)])
+    else:
+        return([])
+
+def _ring_overlap_areas_(coords,min_col,min_row,max_col,max_row,chunk):
+    "Area of a closed ring's interior falling in each cell."
+    x0,y0 = coords[:-1,0].reshape(-1,1),coords[:-1,1].reshape(-1,1)
+    x1,y1 = coords[1:,0].reshape(-1,1),coords[1:,1].reshape(-1,1)
+    dx = x1-x0
+    ## vertical edges do not contribute
+    slope = (y1-y0)/np.where(dx == 0,1.0,dx)
+    direction = np.sign(dx)
+    xmin = np.minimum(x0,x1)
+    xmax = np.maximum(x0,x1)
+    height = max_row-min_row
+    total = np.zeros(len(min_col))
+    step = max(1,chunk//len(min_col))
+    for start in xrange(0,len(x0),step):
+        sl = slice(start,start+step)
+        ## portion of the edge falling in each cell's column
+        xl = np.maximum(xmin[sl],min_col)
+        xr = np.minimum(xmax[sl],max_col)
+        width = np.maximum(xr-xl,0.0)
+        ## edge heights at the column limits relative to the cell bottom
+        yl = y0[sl]+(xl-x0[sl])*slope[sl]-min_row
+        yr = y0[sl]+(xr-x0[sl])*slope[sl]-min_row
+        mean = _clamped_mean_(np.minimum(yl,yr),np.maximum(yl,yr),height)
+        total += (direction[sl]*width*mean).sum(axis=0)
+    ## the sign of the integral depends on the ring orientation
+    signed = (coords[:-1,0]*coords[1:,1]-coords[1:,0]*coords[:-1,1]).sum()
+    return(-np.sign(signed)*total)
+
+def _clamped_mean_(lo,hi,height):
+    "Mean of y clamped to [0,height] for y uniform over [lo,hi]."
+    span = hi-lo
+    below = np.minimum(np.maximum(0.0,lo),hi)-lo
+    above = hi-np.minimum(np.maximum(height,lo),hi)
+    mlo = np.minimum(np.maximum(lo,0.0),height)
+    mhi = np.minimum(np.maximum(hi,0.0),height)
+    inside = span-below-above
+    total = height*above+0.5*(mlo+mhi)*inside
+    return(np.where(span > 0,total/np.where(span > 0,span,1.0),mlo))
     
 def make_poly_array(min_row,min_col,max_row,max_col,polyint=None):
     ret = Polygon(((min_col,min_row),
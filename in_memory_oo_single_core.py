@@ -13,6 +13,7 @@ from shapely.geometry.multipolygon import MultiPolygon, MultiPolygonAdapter
 from shapely import prepared, wkt
 from shapely.geometry.geo import asShape
 import time
+from util.helpers import mask_fill
 
 dtime = 0
 
@@ -288,13 +289,6 @@ class OcgDataset(object):
         
         return(npd)
     
-    def _is_masked_(self,arg):
-        "Ensures proper formating of masked data."
-        if isinstance(arg,np.ma.MaskedArray):
-            return None
-        else:
-            return arg
-    
     def extract_elements(self,*args,**kwds):
         """
         Merges the geometries and extracted attributes into a GeoJson-like dictionary
@@ -308,6 +302,7 @@ class OcgDataset(object):
         clip=False -- set to True to perform a full intersection
         """
         print('extracting elements...')
+        var = args[0]
         ## dissolve argument is unique to extract_elements
         if 'dissolve' in kwds:
             dissolve = kwds.pop('dissolve')
@@ -372,45 +367,42 @@ class OcgDataset(object):
                     feature = dict(
                         id=ids.next(),
                         geometry=unioned,
-                        properties=dict({VAR:float(weighted[kk,:,:].sum()),
+                        properties=dict({var:float(weighted[kk,:,:].sum()),
                                         'timestamp':self.timevec[self._idxtime[kk]]}))
                 elif ocgShape==4:
                     feature = dict(
                         id=ids.next(),
                         geometry=unioned,
-                        properties=dict({VAR:list(float(weighted[kk,x,:,:].sum()) for x in xrange(len(levels))),
+                        properties=dict({var:list(float(weighted[kk,x,:,:].sum()) for x in xrange(len(levels))),
                                         'timestamp':self.timevec[self._idxtime[kk]],
                                         'levels':list(x for x in self.dataset.variables[self.level_name][levels])}))
                 features.append(feature)
         else:
-            ## loop for each feature. no dissolving.
-            for ii,jj in self._itr_array_(self._mask):
-                ## if the data is included, add the feature
-                if self._mask[ii,jj] == True:
-                    ## extract the data and convert any mask values
-                    if ocgShape == 3:
-                        data = [self._is_masked_(da) for da in npd[:,ii,jj]]
-                        for kk in xrange(len(data)):
-                            ## do not add the feature if the value is a NoneType
-                            if data[kk] == None: continue
-                            feature = dict(
-                                id=ids.next(),
-                                geometry=self._igrid[ii,jj],
-                                properties=dict({VAR:float(data[kk]),
-                                                'timestamp':self.timevec[self._idxtime[kk]]}))
-                            features.append(feature)
-                    elif ocgShape == 4:
-                        data = [self._is_masked_(da) for da in npd[:,:,ii,jj]]
-                        for kk in xrange(len(data)):
-                            ## do not add the feature if the value is a NoneType
-                            if data[kk] == None: continue
-                            feature = dict(
-                                id=ids.next(),
-                                geometry=self._igrid[ii,jj],
-                                properties=dict({VAR:list(float(data[kk][x]) for x in xrange(len(levels))),
-                                                'timestamp':self.timevec[self._idxtime[kk]],
-                                                'levels':list(x for x in self.dataset.variables[self.level_name][levels])}))
-                            features.append(feature)
+            ## no dissolving. the valid (cell,time) pairs are found once for
+            ## the block from the mask and features are built only for those.
+            rr,cc = np.nonzero(self._mask)
+            invalid = np.ma.getmaskarray(mask_fill(npd,self.dataset.variables[var]))
+            if ocgShape == 3:
+                values = npd[:,rr,cc]
+                invalid = invalid[:,rr,cc]
+            elif ocgShape == 4:
+                values = npd[:,:,rr,cc].transpose(0,2,1)
+                ## a time step is dropped if any of its levels is masked
+                invalid = invalid[:,:,rr,cc].any(axis=1)
+                lvls = list(x for x in self.dataset.variables[self.level_name][levels])
+            values = np.ma.getdata(values)
+            ## pairs ordered by cell then time
+            nn,tt = np.nonzero(np.invert(invalid).T)
+            for n,t in zip(nn.tolist(),tt.tolist()):
+                if ocgShape == 3:
+                    properties = {var:float(values[t,n])}
+                else:
+                    properties = {var:values[t,n].astype(float).tolist(),
+                                  'levels':lvls}
+                properties['timestamp'] = self.timevec[self._idxtime[t]]
+                features.append(dict(id=ids.next(),
+                                     geometry=self._igrid[rr[n],cc[n]],
+                                     properties=properties))
         print('extraction complete.')
 
         return(features)
@@ -449,21 +441,50 @@ def multipolygon_operation(dataset,var,polygons,time_range=None,clip=None,dissol
                                          dissolve=dissolve,
                                          levels = levels)
 
-    elements2 = []
-
     #expand elements
     dtime = time.time()
-    if not levels == None:
-        for x in elements:
-            for i in xrange(len(levels)):
-                e = x.copy()
-                e['properties'] = x['properties'].copy()
-                e['properties'][var] = e['properties'][var][i]
-                e['properties']['levels'] = e['properties']['levels'][i]
-                elements2.append(e)
+    elements2 = _expand_levels_(elements,var,levels)
     print "expansion time: ",time.time()-dtime
     print(repr(len(elements2)))
     return(elements2)
+
+def multipolygon_iter(dataset,var,polygons,time_range=None,clip=None,dissolve=None,levels = None,ocgOpts=None):
+    """
+    Generator version of multipolygon_operation yielding the elements of each
+    polygon as a list once it is extracted, so only one polygon's elements
+    are held in memory.
+    """
+    ncp = OcgDataset(dataset,**ocgOpts)
+    for polygon in polygons:
+        elements = ncp.extract_elements(var,
+                                        polygon=polygon,
+                                        time_range=time_range,
+                                        clip=clip,
+                                        dissolve=dissolve,
+                                        levels = levels)
+        yield(_expand_levels_(elements,var,levels))
+
+def _expand_levels_(elements,var,levels):
+    """
+    Create a new element for each data level. The (element,level) value and
+    level arrays are flattened to long format at once and the elements are
+    built directly instead of copying each element per level.
+    """
+    if levels == None or len(elements) == 0:
+        return(elements)
+    values = np.array([x['properties'][var] for x in elements],dtype=float).reshape(len(elements),-1)
+    lvls = np.array([x['properties']['levels'] for x in elements]).reshape(values.shape)
+    ## element of each long format row
+    idx = np.repeat(np.arange(len(elements)),values.shape[1])
+    elements2 = []
+    for ii,value,level in zip(idx.tolist(),values.ravel().tolist(),lvls.ravel().tolist()):
+        x = elements[ii]
+        elements2.append(dict(id=x['id'],
+                              geometry=x['geometry'],
+                              properties={var:value,
+                                          'timestamp':x['properties']['timestamp'],
+                                          'levels':level}))
+    return(elements2)
         
         
 if __name__ == '__main__':
@@ -1,11 +1,19 @@
 import unittest
 from shapely.geometry.polygon import Polygon
 from util.ncwrite import NcSpatial, NcTime, NcVariable, NcWrite, NcSubset
+from util.overlay_cache import OverlayCache
+from util.read_plan import ReadPlanner
+from util.helpers import get_temp_path
 import datetime, re
+import itertools
+import gzip
 import os
+import shutil
 import numpy as np
 from netCDF4 import Dataset
+from multiprocessing import Process, Lock
 import in_memory_oo_multi_core as ncconv
+import in_memory_oo_single_core as ncsingle
 
 
 class TestSimpleNc(unittest.TestCase):
@@ -382,8 +390,8 @@ class TestSimpleNc(unittest.TestCase):
 
         lines = [line for line in tft][1:]
 
-        self.assertEqual(lines[1].replace('\n',''),'2,2000-01-01 00:00:00')
-        self.assertEqual(lines[0].replace('\n',''),'1,2000-01-02 00:00:00')
+        self.assertEqual(lines[0].replace('\n',''),'1,2000-01-01 00:00:00')
+        self.assertEqual(lines[1].replace('\n',''),'2,2000-01-02 00:00:00')
 
         lines = [line.replace('\n','').split(',') for line in tfg][1:]
 
@@ -392,8 +400,8 @@ class TestSimpleNc(unittest.TestCase):
 
         lines = [line for line in tfd][1:]
 
-        self.assertEqual(lines[0].replace('\n',''),'1,1,1,0.48851814866065979,1')
-        self.assertEqual(lines[1].replace('\n',''),'0,2,1,1.6243454217910767,1')
+        self.assertEqual(lines[0].replace('\n',''),'0,1,1,1.6243454217910767,1')
+        self.assertEqual(lines[1].replace('\n',''),'1,2,1,0.48851814866065979,1')
 
         tft.close()
         tfg.close()
@@ -431,7 +439,48 @@ class TestSimpleNc(unittest.TestCase):
         tfg.close()
         tfd.close()
 
-
+        #rows are written in time order and time keys follow the time axis
+        #whatever the order of the elements. cell 0 has no value on the
+        #first day.
+        stamps = [datetime.datetime(2000,1,2),datetime.datetime(2000,1,3),datetime.datetime(2000,1,1)]
+        values = np.ma.array([[1.,2.],[3.,4.],[5.,6.]],mask=[[0,0],[0,0],[1,0]])
+        table = ncconv.ElementTable('Prcp',[3,4],[Polygon(((0,0),(1,0),(1,1))),Polygon(((0,0),(2,0),(2,2)))],stamps,values)
+        for source in [table,list(table.iter_elements())]:
+            ncconv.as_keyTabular(source,'Prcp',path='./test_keyTabular.txt')
+            with open('./test_keyTabular_time.txt','r') as tft:
+                lines = [line.replace('\n','') for line in tft][1:]
+            self.assertEqual(lines,['1,2000-01-01 00:00:00','2,2000-01-02 00:00:00','3,2000-01-03 00:00:00'])
+            with open('./test_keyTabular_data.txt','r') as tfd:
+                lines = [line.replace('\n','') for line in tfd][1:]
+            self.assertEqual(lines,['4,1,2,6.0','0,2,1,1.0','2,2,2,2.0','1,3,1,3.0','3,3,2,4.0'])
+
+    def test_tabular_columnar(self):
+        "Tabular outputs of a columnar result match the element outputs"
+        poly = Polygon(((0,0),(20,0),(20,20),(0,20)))
+        for layer,levels in [(self.singleLayer,None),(self.multiLayer,[1])]:
+            elements = self._access(layer,poly,None,False,False,levels,False,'detect')
+            table = ncconv.multipolygon_multicore_operation(layer,'Prcp',[poly],levels=levels,
+                                                            ocgOpts=self._opts(),columnar=True)
+            path = ncconv.as_tabular(elements,'Prcp',wkt=True,path='./test_tabular.txt')
+            with open(path,'r') as f:
+                ref = f.readlines()
+            path = ncconv.as_tabular(table,'Prcp',wkt=True,compress=True,block=3)
+            self.assertTrue(path.endswith('.txt.gz'))
+            f = gzip.open(path,'rb')
+            try:
+                self.assertEqual(f.readlines(),ref)
+            finally:
+                f.close()
+
+            ncconv.as_keyTabular(elements,'Prcp',wkt=True,path='./test_keyTabular.txt')
+            ncconv.as_keyTabular(table,'Prcp',wkt=True,path='./test_keyColumnar.txt',block=3)
+            ncconv.as_keyTabular(iter(elements),'Prcp',wkt=True,path='./test_keyBlocks.txt',block=2)
+            for suffix in ['_time.txt','_geometry.txt','_data.txt']:
+                with open('./test_keyTabular'+suffix,'r') as f:
+                    ref = f.readlines()
+                for other in ['./test_keyColumnar','./test_keyBlocks']:
+                    with open(other+suffix,'r') as f:
+                        self.assertEqual(f.readlines(),ref)
 
 #----------------------------------time, layers-----------------------------
 
@@ -1064,6 +1113,555 @@ class TestSimpleNc(unittest.TestCase):
         c = [self._getCtrd(x) for x in elements]
         self.assertTrue((10,10) in c and (10,20) in c)
 
+#----------------------------------overlay tests----------------------------
+
+    def _reverse_bounds(self,uri):
+        "Copy of a dataset storing its cell bounds as [hi,lo]."
+        path = get_temp_path(suffix='.nc')
+        shutil.copy(uri,path)
+        ds = Dataset(path,'a')
+        for name in ['bounds_latitude','bounds_longitude']:
+            ds.variables[name][:] = ds.variables[name][:][:,::-1]
+        ds.close()
+        return(path)
+
+    def _opts(self,**kwds):
+        "Dataset options of the generated files."
+        opts = {
+            'rowbnds_name': 'bounds_latitude', 
+            'colbnds_name': 'bounds_longitude',
+            'time_units': 'days since 1800-01-01 00:00:00 0:00',
+            'level_name': 'level',
+            'calendar': 'gregorian'
+        }
+        opts.update(kwds)
+        return opts
+
+    def _ocg(self,uri,**kwds):
+        return ncconv.OcgDataset(uri,**self._opts(**kwds))
+
+    def test_overlay_vectorized(self):
+        "Bulk overlay matches the per-cell intersection loop"
+        polys = [Polygon(((0,0),(0,10),(30,40),(40,40),(40,30),(10,0))),
+                 Polygon(((2.5,2.5),(17.5,2.5),(17.5,17.5),(2.5,17.5))),
+                 Polygon(((5,5),(35,12),(20,37)),[((15,15),(20,15),(18,20))])]
+        for clip in [False,True]:
+            for poly in polys:
+                loop = self._ocg(self.singleLayer,overlay='loop')
+                loop._set_overlay_(polygon=poly,clip=clip)
+                vec = self._ocg(self.singleLayer)
+                vec._set_overlay_(polygon=poly,clip=clip)
+
+                np.testing.assert_array_equal(loop._mask,vec._mask)
+                np.testing.assert_array_equal(loop._pgrid,vec._pgrid)
+                np.testing.assert_array_almost_equal(loop._weights,vec._weights,12)
+                for a,b in zip(loop._geometries_(loop._mask),vec._geometries_(vec._mask)):
+                    self.assertAlmostEqual(a.area,b.area,12)
+
+    def test_overlay_reversed_bounds(self):
+        "Cell bounds stored as [hi,lo] give the same overlay"
+        uri = self._reverse_bounds(self.singleLayer)
+        for poly in [Polygon(((5,5),(35,12),(20,37))),Polygon(((2.5,2.5),(17.5,2.5),(17.5,17.5),(2.5,17.5)))]:
+            for overlay in ['vectorized','loop']:
+                for clip in [False,True]:
+                    ref = self._ocg(self.singleLayer,overlay=overlay)
+                    ref._set_overlay_(polygon=poly,clip=clip)
+                    rev = self._ocg(uri,overlay=overlay)
+                    rev._set_overlay_(polygon=poly,clip=clip)
+                    np.testing.assert_array_equal(rev._mask,ref._mask)
+                    np.testing.assert_array_equal(rev._pgrid,ref._pgrid)
+                    np.testing.assert_array_almost_equal(rev._weights,ref._weights,12)
+
+    def test_overlay_rectangle(self):
+        "Rectangular areas of interest are weighted without geometry operations"
+        self.assertTrue(ncconv.is_rectangle(Polygon(((2.5,2.5),(17.5,2.5),(17.5,17.5),(2.5,17.5)))))
+        self.assertFalse(ncconv.is_rectangle(Polygon(((0,0),(10,0),(0,10)))))
+
+        ocg = self._ocg(self.singleLayer)
+        ocg._set_overlay_(polygon=Polygon(((5,5),(35,5),(35,15),(5,15))),clip=True)
+        self.assertEqual(ocg._mask.sum(),8)
+        self.assertAlmostEqual(ocg._weights.sum(),3.0)
+        self.assertTrue(all(g is None for g in ocg._igrid.flat))
+        self.assertAlmostEqual(sum(g.area for g in ocg._geometries_(ocg._mask)),300.0)
+
+    def test_classify_cells(self):
+        "Cells are labeled inside, outside or boundary of the area of interest"
+        bnds = np.array([[0,10],[10,20],[20,30],[30,40]])
+        poly = Polygon(((-5,-5),(45,-5),(45,45),(-5,45)),[((19,19),(31,19),(31,31),(19,31))])
+        label = ncconv.classify_cells(poly,bnds,bnds)
+
+        self.assertEqual(label[2,2],ncconv.CELL_OUTSIDE)
+        self.assertEqual((label == ncconv.CELL_BOUNDARY).sum(),8)
+        self.assertEqual((label == ncconv.CELL_INSIDE).sum(),7)
+        self.assertTrue((label[0,:] == ncconv.CELL_INSIDE).all())
+
+    def test_overlay_window(self):
+        "Overlay arrays cover only the cells overlapping the polygon's envelope"
+        asc = np.array([[0,10],[10,20],[20,30],[30,40]])
+        self.assertEqual(ncconv.bounds_window(asc,12,25),(1,3))
+        self.assertEqual(ncconv.bounds_window(asc[::-1],12,25),(1,3))
+        self.assertEqual(ncconv.bounds_window(asc,50,60),(4,4))
+
+        ocg = self._ocg(self.singleLayer)
+        ocg._set_overlay_(polygon=Polygon(((12,2),(25,2),(25,8))))
+        self.assertEqual(ocg._weights.shape,(1,2))
+        ocg._set_spatial_(polygon=Polygon(((12,2),(25,2),(25,8))))
+        self.assertEqual(list(ocg._idxrow),[0])
+        self.assertEqual(list(ocg._idxcol),[1,2])
+
+    def test_lazy_grid(self):
+        "Grid coordinate arrays are views of the 1-d bounds"
+        ocg = self._ocg(self.singleLayer)
+        self.assertEqual(ocg.min_row.shape,(len(ocg.row_bnds),len(ocg.col_bnds)))
+        self.assertEqual(ocg.min_row.strides[1],0)
+        self.assertEqual(ocg.max_col.strides[0],0)
+        np.testing.assert_array_equal(ocg.max_row[:,2],ocg.row_bnds[:,1])
+        np.testing.assert_array_equal(ocg.real_col[1],np.arange(len(ocg.col_bnds)))
+        self.assertEqual(ocg.grid.window(12,15,25,38),(1,2,2,4))
+
+        ## clipped cell geometries are built once they are requested and
+        ## only those are held by the overlay
+        poly = Polygon(((5,5),(35,12),(20,37)))
+        ocg._set_spatial_(polygon=poly,clip=True)
+        self.assertTrue(all(g is None for g in ocg._igrid.flat))
+        geoms = ocg._geometries_(ocg._mask)
+        clipped = [g is not None for g in ocg._igrid[ocg._mask]]
+        self.assertEqual(clipped,list(ocg._weights[ocg._mask] < 1))
+        for g,w in zip(geoms,ocg._weights[ocg._mask]):
+            self.assertAlmostEqual(g.area,w*100)
+        cell = 2*len(ocg.col_bnds)+3
+        box = ocg._make_poly_(ocg.row_bnds[2],ocg.col_bnds[3])
+        self.assertEqual(ocg.cell_geometry(cell).wkt,box.wkt)
+        self.assertEqual(len(ocg.cell_wkb(cell)),len(box.wkb))
+
+    def test_time_range(self):
+        "Time ranges are selected on the numeric time vector"
+        ocg = self._ocg(self.singleLayer)
+        ocg._set_time_([datetime.datetime(2000,1,3),datetime.datetime(2000,1,5,12)])
+        self.assertEqual(list(ocg._idxtime),[2,3,4])
+        self.assertEqual(list(ocg._timestamps),list(ocg.timevec[2:5]))
+        self.assertEqual(ocg._timestamps[0],datetime.datetime(2000,1,3))
+
+        ocg._set_time_([datetime.datetime(2001,1,1),datetime.datetime(2001,2,1)])
+        self.assertEqual(len(ocg._idxtime),0)
+        self.assertEqual(len(ocg._timestamps),0)
+
+    def test_read_block(self):
+        "Blocks are read as slices with levels coalesced into contiguous runs"
+        self.assertEqual(ncconv._level_runs_([0,1,3]),[slice(0,2),slice(3,4)])
+        self.assertEqual(ncconv._as_slice_(np.arange(3,6)),slice(3,6))
+
+        ocg = self._ocg(self.multiLayer)
+        npd = ocg._get_numpy_data_('Prcp',polygon=Polygon(((5,5),(35,12),(20,37))),levels=[3,0,1])
+        ref = ocg.dataset.variables['Prcp'][:,[3,0,1]][:,:,ocg._idxrow[0]:ocg._idxrow[-1]+1,ocg._idxcol[0]:ocg._idxcol[-1]+1]
+        np.testing.assert_array_equal(npd,ref)
+        self.assertEqual(ocg.read_log[-1]['reads'],2)
+        self.assertEqual(ocg.read_log[-1]['shape'],npd.shape)
+
+        ## the file lock is released when a read fails
+        lock = Lock()
+        def _fail(levels):
+            raise IOError('read failed')
+        runs = ncconv._level_runs_
+        ncconv._level_runs_ = _fail
+        try:
+            self.assertRaises(IOError,ocg._get_numpy_data_,'Prcp',polygon=Polygon(((5,5),(35,12),(20,37))),
+                              levels=[0,1],lock=lock)
+        finally:
+            ncconv._level_runs_ = runs
+        self.assertTrue(lock.acquire(False))
+
+    def test_mask_fill(self):
+        "Fill values are masked once per block and masked cells are dropped"
+        uri = self.get_uri(bounds=Polygon(((0,0),(40,0),(40,20),(0,40))),rng=[datetime.datetime(2000,1,1),datetime.datetime(2000,1,10)],res=10,constant=None,seed=1)
+        ds = Dataset(uri,'a')
+        ds.variables['Prcp'][:,0,0] = np.ma.masked
+        ds.variables['Prcp'][3,1,1] = np.ma.masked
+        ds.close()
+        ds = Dataset(uri,'r')
+        variable = ds.variables['Prcp']
+        variable.set_auto_mask(False)
+        npd = ncconv.mask_fill(variable[:],variable)
+        self.assertEqual(npd.mask.sum(),11)
+        self.assertTrue(npd.mask[3,1,1])
+        ds.close()
+
+        elements = self._access(self.singleLayer,Polygon(((0,0),(20,0),(20,20),(0,20))),None,False,False,None,False,'detect')
+        masked = self._access(uri,Polygon(((0,0),(20,0),(20,20),(0,20))),None,False,False,None,False,'detect')
+        self.assertEqual(len(elements)-len(masked),11)
+        table = ncconv.multipolygon_multicore_operation(uri,'Prcp',[Polygon(((0,0),(20,0),(20,20),(0,20)))],
+                                                       ocgOpts=self._opts(),columnar=True)
+        self.assertEqual(len(table.cells),3)
+
+    def test_dissolve_masked(self):
+        "Dissolves renormalize the weights where values are masked"
+        uri = self.get_uri(bounds=Polygon(((0,0),(40,0),(40,20),(0,40))),rng=[datetime.datetime(2000,1,1),datetime.datetime(2000,1,10)],res=10,constant=None,seed=1,nlevels=4)
+        ds = Dataset(uri,'a')
+        ds.variables['Prcp'][1,0,1,1] = np.ma.masked
+        ds.variables['Prcp'][2,:,:,:] = np.ma.masked
+        ds.close()
+        poly = Polygon(((5,5),(35,12),(20,37)))
+        ref = self._ocg(uri)
+        npd = ref._get_numpy_data_('Prcp',polygon=poly,clip=True,levels=[0,1])
+        w = ref._weights*np.invert(np.ma.getmaskarray(npd))
+        with np.errstate(invalid='ignore'):
+            mean = (np.ma.getdata(npd)*w).sum(axis=3).sum(axis=2)/w.sum(axis=3).sum(axis=2)
+
+        elements = self._access(uri,poly,None,True,True,[0,1],True,'detect')
+        self.assertEqual(len(elements),9*2)
+        for e in elements:
+            t = list(ref._timestamps).index(e['properties']['timestamp'])
+            self.assertNotEqual(t,2)
+            self.assertAlmostEqual(e['properties']['Prcp'],mean[t,list(ref.levels).index(e['properties']['level'])])
+        self.assertAlmostEqual(elements[0]['geometry'].area,poly.area)
+
+    def test_read_plan(self):
+        "Planned reads decode each chunk once"
+        path = get_temp_path(suffix='.nc')
+        ds = Dataset(path,'w')
+        ds.createDimension('time',4)
+        ds.createDimension('lat',8)
+        ds.createDimension('lon',8)
+        var = ds.createVariable('Prcp','f8',('time','lat','lon'),zlib=True,chunksizes=(2,4,4))
+        var[:] = np.arange(256).reshape(4,8,8)
+        ds.close()
+
+        ds = Dataset(path,'r')
+        planner = ReadPlanner(ds.variables['Prcp'])
+        windows = [[(0,2),(0,3),(0,3)],[(0,2),(1,4),(2,4)],[(2,4),(5,7),(5,7)],None]
+        blocks = planner.read(windows)
+        self.assertTrue(blocks[0] is blocks[1])
+        self.assertTrue(blocks[3] is None)
+        self.assertEqual((planner.chunks_touched,planner.chunks_unique,planner.chunks_decoded),(3,2,2))
+        np.testing.assert_array_equal(blocks[2].extract([slice(2,4),slice(5,7),np.array([6,5])]),
+                                      ds.variables['Prcp'][2:4,5:7][:,:,[6,5]])
+
+        ## windows chained by overlaps are merged into blocks within the limit
+        tiles = [[(0,4),(0,8),(ii,ii+2)] for ii in range(7)]
+        bounds,owner = ReadPlanner(ds.variables['Prcp']).plan(tiles)
+        self.assertEqual((bounds,owner),([((0,4),(0,8),(0,8))],[0]*7))
+        bounds,owner = ReadPlanner(ds.variables['Prcp'],max_block_bytes=4*8*4*8).plan(tiles)
+        self.assertEqual(bounds,[((0,4),(0,8),(0,4)),((0,4),(0,8),(0,8)),((0,4),(0,8),(4,8))])
+        self.assertEqual(owner,[0,0,0,1,2,2,2])
+
+        ## blocks filled by a reader process in shared memory
+        shared = ReadPlanner(ds.variables['Prcp']).schedule(windows,path,'Prcp')
+        np.testing.assert_array_equal(shared[1].extract([slice(0,2),slice(1,4),slice(2,4)]),
+                                      ds.variables['Prcp'][0:2,1:4,2:4])
+        shared = ReadPlanner(ds.variables['Prcp']).schedule(windows,path+'.missing','Prcp')
+        self.assertRaises(IOError,lambda: shared[0].data)
+
+        ocg = self._ocg(self.singleLayer)
+        poly = Polygon(((5,5),(35,12),(20,37)))
+        ref = ocg._get_numpy_data_('Prcp',polygon=poly)
+        planner = ncconv.plan_reads(ocg,'Prcp',[poly])
+        ocg.block = planner.blocks[0]
+        planner.reader.join()
+        self.assertEqual(planner.reader.exitcode,0)
+        np.testing.assert_array_equal(ocg._get_numpy_data_('Prcp',polygon=poly),ref)
+        self.assertEqual(len(ocg.read_log),1)
+        self.assertTrue(ncconv.plan_reads(ocg,'Prcp',[poly],max_bytes=100) is None)
+        ds.close()
+
+    def test_worker_tasks(self):
+        "Pool workers reuse one dataset for tasks carrying WKB and options"
+        ncconv._init_worker_(self.singleLayer,self._opts(),[None,None])
+        ocg = ncconv._worker_ocg
+        options = dict(var='Prcp',time_range=None,clip=False,dissolve=False,levels=None,parentPoly=0)
+        for block in [0,1]:
+            options['block'] = block
+            payload = ncconv._extract_task_(Polygon(((0,0),(10,0),(10,10),(0,10))).wkb,options)
+            self.assertTrue(ncconv._worker_ocg is ocg)
+            table = ncconv.ElementTable.unpack(payload,ocg.cell_geometry)
+            self.assertEqual(len(table),10)
+            self.assertEqual(table.geometry(0).bounds,(0,0,10,10))
+
+        ## clipped geometries travel as wkb and large values through shared memory
+        poly = Polygon(((5,5),(35,12),(20,37)))
+        table = ncconv._TaskResult()
+        ocg.extract_elements(table,'Prcp',polygon=poly,clip=True)
+        table = table.value
+        ## clipped geometries are not built before they are requested
+        self.assertTrue(all(g is None for g in table.geometries))
+        self.assertEqual(sum(c is not None for c in table.clips),(table.weights < 1).sum())
+        payload = table.pack(threshold=0)
+        self.assertEqual(len(payload['clip_wkb']),1)
+        self.assertTrue(os.path.exists(payload['path']))
+        unpacked = ncconv.ElementTable.unpack(payload,ocg.cell_geometry)
+        self.assertFalse(os.path.exists(payload['path']))
+        np.testing.assert_array_equal(unpacked.values,table.values)
+        np.testing.assert_array_equal(unpacked.shared,table.shared)
+        np.testing.assert_array_equal(unpacked.weights,table.weights)
+        self.assertTrue(((table.weights > 0)*(table.weights < 1)).any())
+        for ii in range(len(table.cells)):
+            self.assertTrue(unpacked.geometry(ii).equals(table.geometry(ii)))
+
+        ## files of results never unpacked are removed by their prefix
+        kept = table.pack(threshold=0)
+        lost = table.pack(threshold=0,prefix=ncconv.SHARED_PREFIX%os.getpid()+'test-')
+        ncconv.remove_shared(ncconv.SHARED_PREFIX%os.getpid()+'test-')
+        self.assertFalse(os.path.exists(lost['path']))
+        self.assertTrue(os.path.exists(kept['path']))
+        ncconv.remove_shared()
+        self.assertFalse(os.path.exists(kept['path']))
+
+        elements = self._access(self.singleLayer,Polygon(((0,0),(40,0),(40,20),(0,40))),None,False,False,None,True,5)
+        self.assertEqual(len(elements),14*10)
+
+        ## the pool has no more workers than jobs
+        ncp,tasks,collector,pool,planner = ncconv._submit_tasks_(self.singleLayer,'Prcp',[Polygon(((0,0),(10,0),(10,10),(0,10)))],
+                                                                 None,False,False,None,self._opts(),False,'detect',0,8,True)
+        self.assertEqual(len(pool._pool),1)
+        collector.wait()
+        ncconv._close_pool_(ncp,pool,planner,True)
+
+    def test_columnar_repeat(self):
+        "Extractions read the same data while earlier tables are kept"
+        poly = Polygon(((0,0),(20,0),(20,20),(0,20)))
+        tables = [ncconv.multipolygon_multicore_operation(self.singleLayer,'Prcp',[poly],clip=True,
+                                                          ocgOpts=self._opts(),columnar=True) for ii in range(3)]
+        for table in tables[1:]:
+            self.assertEqual(table.values.tolist(),tables[0].values.tolist())
+
+    def test_long_format(self):
+        "Multi-level values are expanded in long format on the arrays"
+        values = np.ma.masked_array(np.arange(12.0).reshape(2,3,2),mask=False)
+        values[1,0,1] = np.ma.masked
+        table = ncconv.ElementTable('Prcp',[7,8,9],[Polygon(((0,0),(1,0),(1,1)))]*3,
+                                    [datetime.datetime(2000,1,1),datetime.datetime(2000,1,2)],values,[10,20])
+        cells,times,levels,data = table.long_format()
+        self.assertEqual(list(cells),[0,0,0,1,1,1,1,2,2,2,2])
+        self.assertEqual(list(times),[0,0,1,0,0,1,1,0,0,1,1])
+        self.assertEqual(list(levels),[0,1,0,0,1,0,1,0,1,0,1])
+        self.assertEqual(list(data),[0,1,6,2,3,8,9,4,5,10,11])
+        elements = list(table.iter_elements())
+        self.assertEqual(len(elements),len(table))
+        self.assertEqual(elements[2]['properties'],{'Prcp':6.0,'timestamp':datetime.datetime(2000,1,2),'level':10})
+        self.assertEqual(elements[-1]['id'],11)
+
+    def test_single_core_long_format(self):
+        "Single core multi-level elements are expanded to one element per level"
+        geom = Polygon(((0,0),(1,0),(1,1)))
+        elements = [dict(id=1,geometry=geom,properties={'Prcp':[1.0,2.0],'timestamp':1,'levels':[10,20]}),
+                    dict(id=2,geometry=geom,properties={'Prcp':[3.0,4.0],'timestamp':2,'levels':[10,20]})]
+        expanded = ncsingle._expand_levels_(elements,'Prcp',[0,1])
+        self.assertEqual([(e['id'],e['properties']) for e in expanded],
+                         [(1,{'Prcp':1.0,'timestamp':1,'levels':10}),(1,{'Prcp':2.0,'timestamp':1,'levels':20}),
+                          (2,{'Prcp':3.0,'timestamp':2,'levels':10}),(2,{'Prcp':4.0,'timestamp':2,'levels':20})])
+        self.assertEqual(ncsingle._expand_levels_([],'Prcp',[0,1]),[])
+
+        ## the levels of an extraction match the multicore long format
+        poly = Polygon(((0,0),(20,0),(20,20),(0,20)))
+        ds = Dataset(self.multiLayer)
+        try:
+            elements = ncsingle.multipolygon_operation(ds,'Prcp',[poly],levels=[0,2],ocgOpts=self._opts())
+        finally:
+            ds.close()
+        ref = self._access(self.multiLayer,poly,None,False,False,[0,2],False,'detect')
+        key = lambda e,name: (round(e['geometry'].centroid.x,6),round(e['geometry'].centroid.y,6),
+                              e['properties']['timestamp'],e['properties'][name],round(e['properties']['Prcp'],6))
+        self.assertEqual(len(elements),4*10*2)
+        self.assertEqual(sorted(key(e,'levels') for e in elements),sorted(key(e,'level') for e in ref))
+
+    def test_result_collector(self):
+        "Task results are merged as they complete"
+        collector = ncconv._ResultCollector(3,True)
+        collector.add((0,[1]))
+        collector.add(None)
+        self.assertFalse(collector.done.is_set())
+        collector.add((0,[2]))
+        collector.wait()
+        self.assertEqual(collector.groups,{0:[[1],[2]]})
+
+        collector = ncconv._ResultCollector(0,True)
+        collector.wait()
+        self.assertEqual(collector.groups,{})
+
+        ## waiting fails instead of blocking when a worker died
+        worker = Process(target=os._exit,args=(1,))
+        worker.start()
+        worker.join()
+        collector = ncconv._ResultCollector(1,False)
+        collector.workers = [worker]
+        self.assertRaises(RuntimeError,collector.wait)
+
+        ## a task failing outside the extraction still returns
+        ncconv._init_worker_(self.singleLayer,self._opts(),[None])
+        self.assertTrue(ncconv._extract_task_(Polygon(((0,0),(10,0),(10,10),(0,10))).wkb,dict(var='Prcp',block=1)) is None)
+
+    def test_multicore_iter(self):
+        "Streamed chunks hold the same elements as the list api"
+        polys = [Polygon(((0,0),(40,0),(40,20),(0,40))),Polygon(((5,5),(35,12),(20,37)))]
+        key = lambda e: (round(e['geometry'].centroid.x,6),round(e['geometry'].centroid.y,6),
+                         round(e['geometry'].area,6),e['properties']['timestamp'],
+                         round(e['properties']['Prcp'],6))
+        for clip,dissolve in [(False,False),(True,False),(True,True)]:
+            ref = ncconv.multipolygon_multicore_operation(self.singleLayer,'Prcp',polys,clip=clip,dissolve=dissolve,
+                                                          ocgOpts=self._opts(),subdivide=True,subres=7,maxProc=2)
+            chunks = list(ncconv.multipolygon_multicore_iter(self.singleLayer,'Prcp',polys,clip=clip,dissolve=dissolve,
+                                                             ocgOpts=self._opts(),subdivide=True,subres=7,maxProc=2))
+            self.assertTrue(len(chunks) > 1)
+            elements = list(itertools.chain.from_iterable(chunks))
+            self.assertEqual(sorted(map(key,ref)),sorted(map(key,elements)))
+            if not dissolve:
+                self.assertEqual([e['id'] for e in elements],range(1,len(elements)+1))
+
+        ## the workers are stopped when the consumer stops early
+        chunks = ncconv.multipolygon_multicore_iter(self.singleLayer,'Prcp',polys,ocgOpts=self._opts(),maxProc=2)
+        self.assertTrue(len(chunks.next()) > 0)
+        chunks.close()
+
+    def test_single_core_iter(self):
+        "The single core generator yields the elements of each polygon"
+        polys = [Polygon(((0,0),(20,0),(20,20),(0,20))),Polygon(((21,1),(39,1),(39,12),(21,12)))]
+        key = lambda e: (round(e['geometry'].centroid.x,6),round(e['geometry'].centroid.y,6),
+                         e['properties']['timestamp'],round(e['properties']['Prcp'],6))
+        ds = Dataset(self.singleLayer)
+        try:
+            chunks = list(ncsingle.multipolygon_iter(ds,'Prcp',polys,ocgOpts=self._opts()))
+            elements = ncsingle.multipolygon_operation(ds,'Prcp',polys,ocgOpts=self._opts())
+        finally:
+            ds.close()
+        self.assertEqual([len(c) for c in chunks],[40,40])
+        self.assertEqual(map(key,itertools.chain.from_iterable(chunks)),map(key,elements))
+        for chunk,poly in zip(chunks,polys):
+            ref = self._access(self.singleLayer,poly,None,False,False,None,False,'detect')
+            self.assertEqual(sorted(map(key,chunk)),sorted(map(key,ref)))
+
+    def test_partition(self):
+        "Polygons are partitioned into tasks of about equal cost"
+        cost = np.zeros((6,6))
+        cost[0,:] = 1
+        cost[:,5] = 1
+        tiles = ncconv.split_tiles(cost,2)
+        self.assertEqual(len(tiles),2)
+        self.assertEqual(sorted(cost[r0:r1,c0:c1].sum() for r0,r1,c0,c1 in tiles),[5,6])
+        self.assertEqual(len(ncconv.split_tiles(np.ones((1,1)),4)),1)
+
+        ## cheap tasks share a batch and costly tasks run alone
+        batches = ncconv.pack_tasks([1,5,2,1,3,1],5)
+        self.assertEqual(batches,[[1],[4,2],[0,3,5]])
+
+        ocg = self._ocg(self.singleLayer)
+        poly = Polygon(((0,0),(0,10),(30,40),(40,40),(40,30),(10,0)))
+        parts = ncconv.partition_polygon(ocg,poly,4,10)
+        self.assertEqual(len(parts),4)
+        self.assertAlmostEqual(sum(p.area for p in parts),poly.area)
+        costs = [ncconv.partition_cost(ocg,p,10) for p in parts]
+        self.assertTrue(max(costs) < 2*min(costs))
+
+        ## every cell of a grid partition is owned by one piece
+        poly = Polygon(((5,5),(35,12),(20,37)))
+        ocg._set_spatial_(polygon=poly)
+        ref = ocg._mask.sum()
+        owned = {}
+        for part in ncconv.grid_partition(ocg,poly,7):
+            ocg._set_spatial_(polygon=part)
+            for r,c in zip(*np.nonzero(ocg._mask)):
+                key = (ocg._idxrow[r],ocg._idxcol[c])
+                owned[key] = owned.get(key,0)+1
+        self.assertEqual(len(owned),ref)
+        self.assertEqual(set(owned.values()),set([1]))
+
+    def test_time_blocks(self):
+        "Small windows over long time series are split along the time axis"
+        uri = self.get_uri(bounds=Polygon(((0,0),(20,0),(20,20),(0,20))),rng=[datetime.datetime(2000,1,1),datetime.datetime(2000,4,9)],res=10,constant=None,seed=1)
+        poly = Polygon(((2.5,2.5),(17.5,2.5),(17.5,7.5),(2.5,7.5)))
+        for dissolve in [False,True]:
+            ref = ncconv.multipolygon_multicore_operation(uri,'Prcp',[poly],clip=True,dissolve=dissolve,
+                                                          ocgOpts=self._opts(),maxProc=1)
+            split = ncconv.multipolygon_multicore_operation(uri,'Prcp',[poly],clip=True,dissolve=dissolve,
+                                                            ocgOpts=self._opts(),maxProc=4)
+            self.assertEqual(len(ref),len(split))
+            key = lambda x: (x['properties']['timestamp'],x['geometry'].centroid.x)
+            ref.sort(key=key)
+            split.sort(key=key)
+            for a,b in zip(ref,split):
+                self.assertEqual(key(a),key(b))
+                self.assertAlmostEqual(a['properties']['Prcp'],b['properties']['Prcp'])
+                self.assertAlmostEqual(a['geometry'].area,b['geometry'].area)
+        self.assertEqual(len(split),100)
+
+        collector = ncconv._ResultCollector(2,True)
+        collector.callback(0,1,2)((0,[3]))
+        collector.callback(0,0,2)((0,[1,2]))
+        collector.wait()
+        self.assertEqual(collector.groups,{0:[[1,2,3]]})
+
+    def test_overlay_cache(self):
+        "Overlays are reused from the on-disk cache"
+        path = get_temp_path()
+        poly = Polygon(((5,5),(35,12),(20,37)))
+        for clip in [False,True]:
+            ref = self._ocg(self.singleLayer)
+            ref._get_numpy_data_('Prcp',polygon=poly,clip=clip)
+            for ii in range(2):
+                ocg = self._ocg(self.singleLayer,overlay_cache=path)
+                ocg._get_numpy_data_('Prcp',polygon=poly,clip=clip)
+                self.assertTrue(os.path.exists(ocg.cache._path_(ocg.overlay_key(poly,clip))))
+
+                np.testing.assert_array_equal(ref._idxrow,ocg._idxrow)
+                np.testing.assert_array_equal(ref._idxcol,ocg._idxcol)
+                np.testing.assert_array_equal(ref._mask,ocg._mask)
+                np.testing.assert_array_equal(ref._pgrid,ocg._pgrid)
+                np.testing.assert_array_equal(ref._weights,ocg._weights)
+                for a,b in zip(ref._geometries_(ref._mask),ocg._geometries_(ocg._mask)):
+                    self.assertTrue(a.equals(b))
+
+    def test_overlay_cache_files(self):
+        "Overlay cache entries are evicted, exported and imported"
+        cache = OverlayCache(get_temp_path())
+        cache.put('a',dict(weights=np.ones((10,10))))
+        size = os.path.getsize(cache._path_('a'))
+        cache.max_size = size
+        cache.put('b',dict(weights=np.zeros((10,10))))
+        self.assertTrue(cache.get('a') is None)
+
+        path = get_temp_path(suffix='.npz')
+        self.assertTrue(cache.export_entry('b',path))
+        other = OverlayCache(get_temp_path())
+        self.assertEqual(other.import_entry(path,key='b'),'b')
+        np.testing.assert_array_equal(other.get('b')['weights'],np.zeros((10,10)))
+
+    def test_zonal_means(self):
+        "Zonal means of many polygons match clipped weighted averages"
+        polys = [Polygon(((5,5),(35,12),(20,37))),
+                 Polygon(((2.5,2.5),(17.5,2.5),(17.5,17.5),(2.5,17.5))),
+                 Polygon(((100,100),(110,100),(110,110)))]
+        ocg = self._ocg(self.multiLayer)
+        ret = ocg.zonal_means('Prcp',polys)
+        self.assertEqual(ret.shape,(3,len(ocg._idxtime),len(ocg.dataset.variables['level'])))
+        self.assertTrue(ret.mask[2].all())
+
+        for ii,poly in enumerate(polys[:2]):
+            ref = self._ocg(self.multiLayer)
+            npd = ref._get_numpy_data_('Prcp',polygon=poly,clip=True,levels=[0,1])
+            w = ref._weights[ref._idxrow[0]:ref._idxrow[-1]+1,ref._idxcol[0]:ref._idxcol[-1]+1]
+            mean = (npd*w).sum(axis=3).sum(axis=2)/w.sum()
+            np.testing.assert_array_almost_equal(ret[ii][:,:2],mean)
+
+        times,values = ncconv.multipolygon_zonal_operation(self.singleLayer,'Prcp',polys[:1],ocgOpts=self._opts())
+        self.assertEqual(values.shape,(1,len(times)))
+
+        ## cell bounds stored as [hi,lo] give the same means
+        rev = self._ocg(self._reverse_bounds(self.multiLayer)).zonal_means('Prcp',polys[:2])
+        self.assertFalse(np.ma.getmaskarray(rev).any())
+        np.testing.assert_array_almost_equal(np.ma.getdata(rev),np.ma.getdata(ret[:2]))
+
+        ## the window is read in blocks of time steps giving the same means
+        size = ncconv.ZONAL_BLOCK_VALUES
+        ncconv.ZONAL_BLOCK_VALUES = 1
+        try:
+            ocg = self._ocg(self.multiLayer)
+            chunked = ocg.zonal_means('Prcp',polys)
+        finally:
+            ncconv.ZONAL_BLOCK_VALUES = size
+        self.assertEqual(len(ocg.read_log),len(ocg._idxtime))
+        np.testing.assert_array_almost_equal(np.ma.getdata(chunked[:2]),np.ma.getdata(ret[:2]))
+
+        ## no level selected
+        self.assertTrue(self._ocg(self.multiLayer).zonal_means('Prcp',polys,levels=[]).mask.all())
+
 class TestOpenDapNC(unittest.TestCase):
 
     def _getCtrd(self,element):
@@ -0,0 +1,292 @@
+import os
+import atexit
+import tempfile
+import numpy as np
+from shapely.ops import cascaded_union
+from shapely.wkb import loads as load_wkb
+
+
+## packed value arrays larger than this many bytes are passed through a file
+## in shared memory instead of the pipe
+SHARED_RESULT_BYTES = 4*1024*1024
+## shared memory files of a process are named after its pid so the ones
+## left by failed tasks can be found and removed
+SHARED_PREFIX = 'ocg-%d-'
+
+
+class ElementTable(object):
+    """
+    Columnar extraction result holding one geometry per cell, the time
+    vector and the values of every cell and time step in a masked array.
+    Elements are produced as GeoJson-like dictionaries on demand by
+    iter_elements.
+
+    var -- name of the extracted variable
+    cells -- (n,) int ndarray of grid cell indices (row*columns+column)
+    geometries -- (n,) object ndarray of shapely geometries. None stands for
+        a geometry built by cell_geometry when needed.
+    timestamps -- (t,) object ndarray of datetime objects
+    values -- (t,n) masked ndarray or (t,n,l) for 4-d variables
+    levels=None -- (l,) sequence of level values for 4-d variables
+    shared=None -- (n,) bool ndarray. True for cells that other tasks may
+        extract as well (i.e. cells partially covered by a sub-polygon or
+        any cell of an unclipped extraction).
+    cell_geometry=None -- function returning the box geometry of a cell index
+        clipped to an optional polygon
+    weights=None -- (n,) float ndarray of the fraction of each cell covered
+        by the polygon. defaults to ones.
+    clips=None -- (n,) object ndarray of the polygons the cells are clipped
+        to. None for whole cells.
+    """
+
+    def __init__(self,var,cells,geometries,timestamps,values,levels=None,shared=None,cell_geometry=None,weights=None,clips=None):
+        self.var = var
+        self.cells = np.asarray(cells,dtype=int)
+        if not isinstance(geometries,np.ndarray):
+            ## filled item by item so geometries are not taken as sequences
+            items = geometries
+            geometries = np.empty(len(items),dtype=object)
+            for ii,geom in enumerate(items):
+                geometries[ii] = geom
+        self.geometries = geometries
+        self.timestamps = np.asarray(timestamps,dtype=object)
+        self.values = np.ma.asarray(values)
+        self.levels = None if levels is None else list(levels)
+        if shared is None:
+            shared = np.zeros(len(self.cells),dtype=bool)
+        self.shared = np.asarray(shared,dtype=bool)
+        self.cell_geometry = cell_geometry
+        if weights is None:
+            weights = np.ones(len(self.cells))
+        self.weights = np.asarray(weights,dtype=float)
+        if clips is None:
+            clips = np.empty(len(self.cells),dtype=object)
+        self.clips = clips
+
+    def __len__(self):
+        "Number of elements, i.e. values that are not masked."
+        return(int(np.invert(np.ma.getmaskarray(self.values)).sum()))
+
+    def iter_elements(self,start=1):
+        """
+        Yield the elements as GeoJson-like dictionaries, one per cell, time
+        step and level. Masked values are skipped.
+
+        start=1 -- first element id
+        """
+        cells,times,levels,values = self.long_format()
+        timestamps = self.timestamps[times]
+        if levels is not None:
+            levels = np.asarray(self.levels,dtype=object)[levels]
+        for row,(ii,value) in enumerate(zip(cells.tolist(),values.tolist())):
+            properties = {self.var:value,'timestamp':timestamps[row]}
+            if levels is not None:
+                properties['level'] = levels[row]
+            yield(dict(id=start+row,geometry=self.geometry(ii),properties=properties))
+
+    def long_format(self):
+        """
+        The unmasked values in long format ordered by cell, time step and
+        level.
+
+        Returns 1-d arrays of the cell position in the table, the time index,
+        the level index (None for 3-d variables) and the values as floats.
+        """
+        ## move the cell axis first so rows are ordered by cell
+        data = np.ma.getdata(self.values).swapaxes(0,1)
+        mask = np.ma.getmaskarray(self.values).swapaxes(0,1)
+        idx = np.nonzero(np.invert(mask))
+        values = data[idx].astype(float)
+        levels = idx[2] if self.levels is not None else None
+        return(idx[0],idx[1],levels,values)
+
+    def geometry(self,ii):
+        "Geometry of the ii-th cell. Cells are built and clipped on first access."
+        geom = self.geometries[ii]
+        if geom is None:
+            if self.clips[ii] is None:
+                geom = self.cell_geometry(self.cells[ii])
+            else:
+                geom = self.cell_geometry(self.cells[ii],self.clips[ii])
+            self.geometries[ii] = geom
+        return(geom)
+
+    def take(self,idx):
+        "Return a table of the cells selected by an index array."
+        return(ElementTable(self.var,self.cells[idx],self.geometries[idx],self.timestamps,
+                            self.values[:,idx],self.levels,self.shared[idx],self.cell_geometry,
+                            self.weights[idx],self.clips[idx]))
+
+    def pack(self,threshold=SHARED_RESULT_BYTES,prefix=None):
+        """
+        Return the table as a dictionary of arrays that pickles compactly.
+        Geometries other than cell boxes are encoded as WKB. Values larger
+        than threshold bytes are written to a file in shared memory which is
+        removed by unpack.
+        
+        prefix=None -- name prefix of the shared memory file. defaults to the
+            SHARED_PREFIX of this process. files of a prefix that were never
+            unpacked are removed by remove_shared.
+        """
+        mask = np.ma.getmaskarray(self.values)
+        payload = dict(var=self.var,
+                       cells=self.cells,
+                       timestamps=self.timestamps,
+                       levels=self.levels,
+                       shared=np.packbits(self.shared),
+                       weights=self.weights,
+                       mask=np.packbits(mask) if mask.any() else None)
+        ## only geometries already built are sent. the others are rebuilt
+        ## from the cell and the polygon it is clipped to, which is sent once.
+        clipped = np.array([g is not None for g in self.geometries],dtype=bool)
+        wkbs = [g.wkb for g in self.geometries[clipped]]
+        payload.update(clipped=np.packbits(clipped),
+                       wkb=np.frombuffer(''.join(wkbs),dtype=np.uint8),
+                       wkb_offsets=np.cumsum([0]+[len(w) for w in wkbs]))
+        polygons = {}
+        clip_index = np.zeros(len(self.cells),dtype=int)-1
+        for ii,polygon in enumerate(self.clips):
+            if polygon is not None:
+                clip_index[ii] = polygons.setdefault(id(polygon),(len(polygons),polygon))[0]
+        payload.update(clip_index=clip_index if len(polygons) > 0 else None,
+                       clip_wkb=[p.wkb for idx,p in sorted(polygons.values())])
+        data = np.ma.getdata(self.values)
+        if data.nbytes > threshold:
+            if prefix is None:
+                prefix = SHARED_PREFIX%os.getpid()
+            fd,path = tempfile.mkstemp(prefix=prefix,suffix='.npy',dir=_shared_dir_())
+            try:
+                with os.fdopen(fd,'wb') as f:
+                    np.save(f,data)
+            except:
+                os.remove(path)
+                raise
+            payload['path'] = path
+        else:
+            payload['data'] = data
+        return(payload)
+
+    @staticmethod
+    def unpack(payload,cell_geometry=None):
+        """
+        Rebuild a table from the output of pack.
+
+        cell_geometry=None -- function returning the box geometry of a cell index
+        """
+        if 'path' in payload:
+            try:
+                data = np.load(payload['path'])
+            finally:
+                os.remove(payload['path'])
+        else:
+            data = payload['data']
+        n = len(payload['cells'])
+        values = data
+        if payload['mask'] is not None:
+            mask = np.unpackbits(payload['mask'])[:data.size].reshape(data.shape).astype(bool)
+            values = np.ma.masked_array(data,mask=mask)
+        geometries = np.empty(n,dtype=object)
+        clipped = np.nonzero(np.unpackbits(payload['clipped'])[:n])[0]
+        wkb,offsets = payload['wkb'].tostring(),payload['wkb_offsets']
+        for idx,ii in enumerate(clipped):
+            geometries[ii] = load_wkb(wkb[offsets[idx]:offsets[idx+1]])
+        shared = np.unpackbits(payload['shared'])[:n].astype(bool)
+        clips = np.empty(n,dtype=object)
+        if payload['clip_index'] is not None:
+            polygons = [load_wkb(w) for w in payload['clip_wkb']]
+            for ii in np.nonzero(payload['clip_index'] >= 0)[0]:
+                clips[ii] = polygons[payload['clip_index'][ii]]
+        return(ElementTable(payload['var'],payload['cells'],geometries,payload['timestamps'],
+                            values,payload['levels'],shared,cell_geometry,payload['weights'],clips))
+
+    @staticmethod
+    def join_time(tables):
+        "Concatenate tables of the same cells over consecutive time blocks."
+        first = tables[0]
+        return(ElementTable(first.var,first.cells,first.geometries,
+                            np.concatenate([t.timestamps for t in tables]),
+                            np.ma.concatenate([t.values for t in tables],axis=0),
+                            first.levels,first.shared,first.cell_geometry,first.weights,first.clips))
+
+    @staticmethod
+    def merge(tables,clip=False):
+        """
+        Merge the tables of spatial tasks sharing the same time steps. Shared
+        cells extracted by several tasks are kept once. In the case of a clip
+        their geometry fragments are unioned.
+
+        Returns None if there are no tables.
+        """
+        tables = [t for t in tables if t is not None]
+        if len(tables) == 0:
+            return(None)
+        unique = [t.take(np.nonzero(np.invert(t.shared))[0]) for t in tables]
+        shared = [t.take(np.nonzero(t.shared)[0]) for t in tables]
+        shared = [t for t in shared if len(t.cells) > 0]
+        if len(shared) > 0:
+            ## join the shared cells on their index keeping the first occurrence
+            joined = ElementTable._concatenate_(shared)
+            cells,first,inverse = np.unique(joined.cells,return_index=True,return_inverse=True)
+            order = np.sort(first)
+            geoms = joined.geometries[order]
+            weights = joined.weights[order]
+            if clip:
+                ## rows of each unique cell in joined order
+                grouped = np.argsort(inverse,kind='mergesort')
+                groups = np.split(grouped,np.nonzero(np.diff(inverse[grouped]))[0]+1)
+                ## union the fragments of cells split between tasks
+                for jj,idx in enumerate(order):
+                    fragments = groups[inverse[idx]]
+                    if len(fragments) > 1:
+                        geoms[jj] = cascaded_union([joined.geometry(f) for f in fragments])
+                        weights[jj] = min(1.0,joined.weights[fragments].sum())
+            joined = joined.take(order)
+            joined.geometries = geoms
+            joined.weights = weights
+            unique.append(joined)
+        return(ElementTable._concatenate_(unique))
+
+    @staticmethod
+    def _concatenate_(tables):
+        "Stack tables of different cells sharing the same time steps."
+        first = tables[0]
+        return(ElementTable(first.var,
+                            np.concatenate([t.cells for t in tables]),
+                            np.concatenate([t.geometries for t in tables]),
+                            first.timestamps,
+                            np.ma.concatenate([t.values for t in tables],axis=1),
+                            first.levels,
+                            np.concatenate([t.shared for t in tables]),
+                            first.cell_geometry,
+                            np.concatenate([t.weights for t in tables]),
+                            np.concatenate([t.clips for t in tables])))
+
+
+def _shared_dir_():
+    "Directory of files passed between processes. /dev/shm where available."
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm',os.W_OK):
+        return('/dev/shm')
+    return(tempfile.gettempdir())
+
+
+def remove_shared(prefix=None):
+    """
+    Remove the shared memory files of packed tables that were never
+    unpacked, e.g. the results of tasks of an abandoned or failed
+    extraction.
+    
+    prefix=None -- name prefix of the files. defaults to the SHARED_PREFIX of
+        this process.
+    """
+    if prefix is None:
+        prefix = SHARED_PREFIX%os.getpid()
+    base = _shared_dir_()
+    for name in os.listdir(base):
+        if name.startswith(prefix) and name.endswith('.npy'):
+            try:
+                os.remove(os.path.join(base,name))
+            except OSError:
+                pass
+
+## pool workers leave through os._exit and do not run this
+atexit.register(remove_shared)
@@ -0,0 +1,106 @@
+import numpy as np
+
+
+class CellGrid(object):
+    """
+    Rectilinear grid of cells described by its 1-d row and column bounds. The
+    2-d coordinate arrays are read-only broadcast views created on demand so
+    constructing a grid takes constant memory regardless of its size.
+
+    row_bnds -- (rows,2) ndarray of row bounds
+    col_bnds -- (cols,2) ndarray of column bounds
+
+    >>> grid = CellGrid(np.array([[0,10],[10,20]]),np.array([[0,5],[5,10],[10,15]]))
+    >>> grid.shape
+    (2, 3)
+    >>> grid.max_col[1,2]
+    15
+    >>> grid.window(4,6,12,14)
+    (0, 1, 2, 3)
+    """
+
+    def __init__(self,row_bnds,col_bnds):
+        self.row_bnds = row_bnds
+        self.col_bnds = col_bnds
+        self.shape = (len(row_bnds),len(col_bnds))
+
+    @property
+    def min_row(self):
+        return(self._rows_(self.row_bnds[:,0]))
+
+    @property
+    def max_row(self):
+        return(self._rows_(self.row_bnds[:,1]))
+
+    @property
+    def min_col(self):
+        return(self._cols_(self.col_bnds[:,0]))
+
+    @property
+    def max_col(self):
+        return(self._cols_(self.col_bnds[:,1]))
+
+    @property
+    def real_row(self):
+        "Row index of each cell."
+        return(self._rows_(np.arange(self.shape[0])))
+
+    @property
+    def real_col(self):
+        "Column index of each cell."
+        return(self._cols_(np.arange(self.shape[1])))
+
+    def window(self,min_row,max_row,min_col,max_col):
+        """
+        Row and column index ranges of the cells overlapping a bounding box.
+
+        Returns (first row, last row + 1, first col, last col + 1).
+        """
+        r0,r1 = bounds_window(self.row_bnds,min_row,max_row)
+        c0,c1 = bounds_window(self.col_bnds,min_col,max_col)
+        return(r0,r1,c0,c1)
+
+    def _rows_(self,values):
+        return(np.broadcast_to(values[:,np.newaxis],self.shape))
+
+    def _cols_(self,values):
+        return(np.broadcast_to(values[np.newaxis,:],self.shape))
+
+
+def bounds_window(bnds,lower,upper):
+    """
+    Index range of the cells whose bounds overlap [lower,upper]. Monotonic
+    bounds are searched with a binary search.
+
+    bnds -- (n,2) ndarray of cell bounds
+
+    Returns (first index, last index + 1).
+
+    >>> bounds_window(np.array([[0,10],[10,20],[20,30]]),12,15)
+    (1, 2)
+    >>> bounds_window(np.array([[20,30],[10,20],[0,10]]),5,15)
+    (1, 3)
+    """
+    lo,hi = np.min(bnds,axis=1),np.max(bnds,axis=1)
+    n = len(lo)
+    if n == 0:
+        return(0,0)
+    dlo,dhi = np.diff(lo),np.diff(hi)
+    if (dlo >= 0).all() and (dhi >= 0).all():
+        start = np.searchsorted(hi,lower,side='left')
+        stop = np.searchsorted(lo,upper,side='right')
+    elif (dlo <= 0).all() and (dhi <= 0).all():
+        start = n-np.searchsorted(lo[::-1],upper,side='right')
+        stop = n-np.searchsorted(hi[::-1],lower,side='left')
+    else:
+        ## unordered bounds fall back to a scan
+        idx = np.nonzero((hi >= lower)*(lo <= upper))[0]
+        if len(idx) == 0:
+            return(0,0)
+        start,stop = idx[0],idx[-1]+1
+    return(int(start),int(max(start,stop)))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -2,6 +2,8 @@ import tempfile
 import re
 import copy
 import pdb
+import numpy as np
+import netCDF4 as nc
 
 
 def get_temp_path(suffix=''):
@@ -10,6 +12,33 @@ def get_temp_path(suffix=''):
     f.close()
     return f.name
 
+def mask_fill(npd,variable):
+    """
+    Mask the fill and missing values of a block of data read without a
+    mask, i.e. from a planned block or with automatic masking disabled.
+    
+    npd -- block of data read from variable
+    variable -- netCDF4 variable object
+    """
+    if isinstance(npd,np.ma.MaskedArray) and npd.mask is not np.ma.nomask:
+        return(npd)
+    data = np.ma.getdata(npd)
+    fills = [getattr(variable,a) for a in ('_FillValue','missing_value') if hasattr(variable,a)]
+    ## without attributes the netCDF default fill value of the type is used
+    if len(fills) == 0 and data.dtype.str[1:] in nc.default_fillvals:
+        fills = [nc.default_fillvals[data.dtype.str[1:]]]
+    if len(fills) == 0:
+        return(npd)
+    invalid = np.zeros(data.shape,dtype=bool)
+    for fill in np.ravel(fills):
+        if np.isnan(fill):
+            invalid |= np.isnan(data)
+        else:
+            invalid |= data == fill
+    if invalid.any():
+        return(np.ma.masked_array(data,mask=invalid))
+    return(npd)
+
 def parse_polygon_wkt(txt):
     """Parse URL polygon text into WKT"""
     
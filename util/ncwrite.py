@@ -297,10 +297,11 @@ def NcSubset(path,ocg,Var,poly,time_range,Levels=None,lat_name='latitude',lon_na
     #print ocg._idxrow.shape
     #print ocg._idxcol.shape
     #print
-    mr  = ocg.min_row[ocg._idxrow,:][:,ocg._idxcol]
-    mxr = ocg.max_row[ocg._idxrow,:][:,ocg._idxcol]
-    mc  = ocg.min_col[ocg._idxrow,:][:,ocg._idxcol]
-    mxc = ocg.max_col[ocg._idxrow,:][:,ocg._idxcol]
+    window = np.ix_(ocg._idxrow,ocg._idxcol)
+    mr  = ocg.min_row[window]
+    mxr = ocg.max_row[window]
+    mc  = ocg.min_col[window]
+    mxc = ocg.max_col[window]
 
     #print ocg.min_row
     #print ocg.min_col
@@ -0,0 +1,155 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+
+class OverlayCache(object):
+    """
+    On-disk cache of overlay results. Each entry is a NumPy .npz file named
+    by its key holding the windowed mask, weights and partial-cell grids and
+    the row/column index ranges. The least recently used entries are evicted
+    once the total size exceeds max_size.
+
+    path -- directory holding the cache entries
+    max_size=None -- maximum total size of the entries in bytes. None is
+        unbounded.
+
+    >>> from shapely.geometry import Polygon
+    >>> from helpers import get_temp_path
+    >>> cache = OverlayCache(get_temp_path())
+    >>> grid = cache.fingerprint(np.array([[0,10]]),np.array([[0,10]]))
+    >>> key = cache.key(grid,Polygon(((0,0),(5,0),(5,5))),False)
+    >>> cache.get(key) is None
+    True
+    >>> cache.put(key,dict(weights=np.array([[0.5]])))
+    >>> float(cache.get(key)['weights'][0,0])
+    0.5
+    """
+
+    suffix = '.npz'
+
+    def __init__(self,path,max_size=None):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    @staticmethod
+    def fingerprint(row_bnds,col_bnds):
+        "Hash identifying a grid by its row and column bounds."
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(row_bnds,dtype=float).tostring())
+        h.update(np.ascontiguousarray(col_bnds,dtype=float).tostring())
+        return(h.hexdigest())
+
+    @staticmethod
+    def key(fingerprint,polygon,clip):
+        "Cache key of an overlay for a grid fingerprint, polygon and clip flag."
+        h = hashlib.sha1()
+        h.update(fingerprint)
+        if polygon is None:
+            h.update('None')
+        else:
+            h.update(polygon.wkb)
+        h.update(repr(bool(clip)))
+        return(h.hexdigest())
+
+    def get(self,key):
+        "Return the entry as a dictionary of arrays or None if it is missing."
+        path = self._path_(key)
+        if not os.path.exists(path):
+            return(None)
+        try:
+            f = np.load(path)
+            try:
+                entry = dict((k,f[k]) for k in f.files)
+            finally:
+                f.close()
+        except (IOError,ValueError,OSError):
+            ## unreadable entries are discarded
+            self._remove_(path)
+            return(None)
+        ## mark the entry as recently used
+        try:
+            os.utime(path,None)
+        except OSError:
+            pass
+        return(entry)
+
+    def put(self,key,entry):
+        "Store a dictionary of arrays under a key."
+        ## write to a temporary file first so concurrent readers never see a
+        ## partial entry
+        fd,tmp = tempfile.mkstemp(suffix=self.suffix,dir=self.path)
+        try:
+            with os.fdopen(fd,'wb') as f:
+                np.savez(f,**entry)
+            os.rename(tmp,self._path_(key))
+        except:
+            self._remove_(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        "Remove least recently used entries until the cache fits max_size."
+        if self.max_size is None:
+            return
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.path,name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime,st.st_size,path))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        for mtime,size,path in entries:
+            if total <= self.max_size:
+                break
+            self._remove_(path)
+            total -= size
+
+    def export_entry(self,key,path):
+        "Copy an entry to a weight file. Returns False if the entry is missing."
+        src = self._path_(key)
+        if not os.path.exists(src):
+            return(False)
+        shutil.copyfile(src,path)
+        return(True)
+
+    def import_entry(self,path,key=None):
+        """
+        Add a weight file created by export_entry to the cache.
+
+        key=None -- key of the entry. taken from the file name if not given.
+        """
+        if key is None:
+            key = os.path.basename(path)
+            if key.endswith(self.suffix):
+                key = key[:-len(self.suffix)]
+        ## validate the file before adding it
+        f = np.load(path)
+        f.close()
+        shutil.copyfile(path,self._path_(key))
+        self.evict()
+        return(key)
+
+    def _path_(self,key):
+        return(os.path.join(self.path,key+self.suffix))
+
+    @staticmethod
+    def _remove_(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
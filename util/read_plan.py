@@ -0,0 +1,366 @@
+import numpy as np
+from multiprocessing import Process, Event
+from multiprocessing.sharedctypes import RawArray, RawValue
+from netCDF4 import Dataset
+
+
+## overlapping windows are not merged into blocks larger than this many bytes
+MAX_BLOCK_BYTES = 256*1024*1024
+
+
+def chunk_shape(variable):
+    """
+    Chunk shape of a netCDF4 variable or None if the variable is stored
+    contiguously or its storage can not be inspected (i.e. OPeNDAP).
+    """
+    try:
+        chunks = variable.chunking()
+    except Exception:
+        return(None)
+    if chunks is None or chunks == 'contiguous':
+        return(None)
+    return(tuple(int(c) for c in chunks))
+
+
+class ReadBlock(object):
+    """
+    A block of data read from a variable.
+
+    bounds -- sequence of (start,stop) index ranges, one per dimension
+    data -- ndarray holding the block
+    """
+
+    def __init__(self,bounds,data):
+        self.bounds = tuple(bounds)
+        self.data = data
+
+    def covers(self,bounds):
+        "True if the index ranges lie within the block."
+        for (start,stop),(bstart,bstop) in zip(bounds,self.bounds):
+            if start < bstart or stop > bstop:
+                return(False)
+        return(True)
+
+    def extract(self,indices):
+        """
+        Return the data selected by one slice or index array per dimension
+        given in variable indices.
+        """
+        sub = []
+        take = []
+        for axis,(idx,(bstart,bstop)) in enumerate(zip(indices,self.bounds)):
+            if isinstance(idx,slice):
+                sub.append(slice(idx.start-bstart,idx.stop-bstart))
+            else:
+                sub.append(slice(None))
+                take.append((axis,np.asarray(idx)-bstart))
+        ret = self.data[tuple(sub)]
+        for axis,idx in take:
+            ret = ret.take(idx,axis=axis)
+        return(ret)
+
+
+class SharedBlock(ReadBlock):
+    """
+    A block of data held in shared memory. The buffers are allocated by the
+    parent process before the workers are forked and filled by a
+    BlockReader. Workers attach to the buffers without copying and wait for
+    the block to be filled on first access.
+
+    bounds -- sequence of (start,stop) index ranges, one per dimension
+    dtype -- data type of the variable
+    """
+
+    def __init__(self,bounds,dtype):
+        self.bounds = tuple(bounds)
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(stop-start for start,stop in self.bounds)
+        size = int(np.prod(self.shape))
+        self._data = RawArray('b',max(1,size*self.dtype.itemsize))
+        self._mask = RawArray('b',max(1,size))
+        self._ready = Event()
+        self._failed = RawValue('b',0)
+
+    @property
+    def data(self):
+        "The block as an ndarray, or a masked array if any values are masked."
+        self._ready.wait()
+        if self._failed.value:
+            raise IOError('reading block {0} failed'.format(self.bounds))
+        return(self._view_())
+
+    def fill(self,data):
+        "Copy data into the shared buffers. Called by the reader."
+        data_view = self._view_(masked=False)
+        data_view[...] = np.ma.getdata(data)
+        self._mask_view_()[...] = np.ma.getmaskarray(data)
+
+    def _view_(self,masked=True):
+        size = int(np.prod(self.shape))
+        data = np.frombuffer(self._data,dtype=self.dtype,count=size).reshape(self.shape)
+        if masked:
+            mask = self._mask_view_()
+            if mask.any():
+                return(np.ma.masked_array(data,mask=mask))
+        return(data)
+
+    def _mask_view_(self):
+        size = int(np.prod(self.shape))
+        return(np.frombuffer(self._mask,dtype=bool,count=size).reshape(self.shape))
+
+
+class BlockReader(Process):
+    """
+    I/O process owning the dataset handle. Reads the blocks in order into
+    their shared buffers and signals each one as soon as it is filled.
+
+    uri -- location of the dataset
+    var -- name of the variable to read
+    blocks -- sequence of SharedBlock objects
+    """
+
+    def __init__(self,uri,var,blocks):
+        Process.__init__(self)
+        self.uri = uri
+        self.var = var
+        self.blocks = blocks
+
+    def run(self):
+        dataset = None
+        try:
+            dataset = Dataset(self.uri,'r')
+            variable = dataset.variables[self.var]
+            for block in self.blocks:
+                try:
+                    block.fill(variable[tuple(slice(start,stop) for start,stop in block.bounds)])
+                except Exception:
+                    block._failed.value = 1
+                finally:
+                    block._ready.set()
+        except Exception:
+            ## the dataset could not be opened. release every waiting worker.
+            for block in self.blocks:
+                if not block._ready.is_set():
+                    block._failed.value = 1
+                    block._ready.set()
+        finally:
+            if dataset is not None:
+                dataset.close()
+
+
+class ReadPlanner(object):
+    """
+    Plans the reads of many windows of a variable so that each chunk of a
+    chunked (and usually compressed) variable is decoded once. Every window is
+    grown to whole chunks and overlapping windows are merged into blocks
+    which are read once and shared by the windows they cover.
+
+    Variables without chunking are treated as having chunks of one element
+    so windows are only merged where they overlap.
+
+    variable -- netCDF4 variable object
+    max_block_bytes=MAX_BLOCK_BYTES -- overlapping windows whose merged block
+        would be larger are read as separate blocks
+
+    After a read, blocks holds the block of each window, chunks_touched is the number of chunks covered by the
+    windows counting repeats, chunks_unique the number of distinct chunks
+    covered and chunks_decoded the number of chunks read. chunks_decoded
+    equals chunks_unique when merging did not pull in chunks outside the
+    windows and no windows were left unmerged by max_block_bytes.
+    """
+
+    def __init__(self,variable,max_block_bytes=MAX_BLOCK_BYTES):
+        self.variable = variable
+        self.max_block_bytes = max_block_bytes
+        self.shape = variable.shape
+        self.chunks = chunk_shape(variable) or (1,)*len(self.shape)
+        self.chunks_touched = 0
+        self.chunks_unique = 0
+        self.chunks_decoded = 0
+        self.reader = None
+        self.blocks = None
+
+    def plan(self,windows):
+        """
+        Merge windows into blocks of whole chunks.
+
+        windows -- sequence of windows. a window is a sequence of (start,stop)
+            index ranges, one per dimension, or None.
+
+        Returns the block bounds and, for each window, the index of the block
+        covering it or None if the window is empty.
+        """
+        boxes = []
+        owner = []
+        for window in windows:
+            if window is None or any(stop <= start for start,stop in window):
+                owner.append(None)
+                continue
+            ## chunk indices covered by the window
+            box = [(start//c,-(-stop//c)) for (start,stop),c in zip(window,self.chunks)]
+            owner.append(len(boxes))
+            boxes.append([box,[len(boxes)]])
+
+        ## merge the groups of overlapping boxes. merged boxes may overlap
+        ## each other so the groups are searched again until none are found.
+        ## groups larger than max_block_bytes are merged in order into
+        ## blocks within the limit which are no longer merged.
+        items = [[box,members,False] for box,members in boxes]
+        while True:
+            active = [item for item in items if not item[2]]
+            groups = _overlap_groups_([item[0] for item in active])
+            if all(len(g) == 1 for g in groups):
+                break
+            items = [item for item in items if item[2]]
+            for g in groups:
+                group = [active[ii] for ii in g]
+                if len(group) == 1:
+                    items.append(group[0])
+                    continue
+                box = _union_([item[0] for item in group])
+                if self._box_bytes_(box) <= self.max_block_bytes:
+                    items.append([box,sum([item[1] for item in group],[]),False])
+                    continue
+                current = None
+                for item in sorted(group):
+                    if current is not None:
+                        box = _union_([current[0],item[0]])
+                        if self._box_bytes_(box) <= self.max_block_bytes:
+                            current = [box,current[1]+item[1],True]
+                            continue
+                        items.append(current)
+                    current = [item[0],item[1],True]
+                items.append(current)
+        ## blocks are read in the order of their first window
+        items.sort(key=lambda item: min(item[1]))
+
+        where = {}
+        bounds = []
+        for ii,(box,members,final) in enumerate(items):
+            for m in members:
+                where[m] = ii
+            bounds.append(self._bounds_(box))
+        return(bounds,[None if o is None else where[o] for o in owner])
+
+    def nbytes(self,bounds):
+        "Number of bytes of the data of blocks given their bounds."
+        size = sum(int(np.prod([stop-start for start,stop in b])) for b in bounds)
+        return(size*self.variable.dtype.itemsize)
+
+    def _box_bytes_(self,box):
+        "Number of bytes of the block of a box of chunk indices."
+        return(self.nbytes([self._bounds_(box)]))
+
+    def _bounds_(self,box):
+        "Variable index ranges of a box of chunk indices."
+        return(tuple((start*c,min(stop*c,n))
+                     for (start,stop),c,n in zip(box,self.chunks,self.shape)))
+
+    def read(self,windows,lock=None):
+        """
+        Read the planned blocks and return, for each window, the ReadBlock
+        covering it or None if the window is empty.
+
+        lock=None -- multiprocessing Lock guarding the file
+        """
+        bounds,owner = self.plan(windows)
+        self._count_(windows,bounds,owner)
+
+        blocks = []
+        for b in bounds:
+            if lock is not None:
+                lock.acquire()
+            try:
+                data = self.variable[tuple(slice(start,stop) for start,stop in b)]
+            finally:
+                if lock is not None:
+                    lock.release()
+            blocks.append(ReadBlock(b,data))
+        self.blocks = [None if o is None else blocks[o] for o in owner]
+        return(self.blocks)
+
+    def schedule(self,windows,uri,var):
+        """
+        Allocate shared-memory blocks for the planned reads and start a
+        BlockReader process filling them in order. Must be called before the
+        workers using the blocks are started.
+
+        uri -- location of the dataset
+        var -- name of the variable
+
+        Returns, for each window, the SharedBlock covering it or None if the
+        window is empty. The reader process is kept in the reader attribute.
+        """
+        bounds,owner = self.plan(windows)
+        self._count_(windows,bounds,owner)
+
+        blocks = [SharedBlock(b,self.variable.dtype) for b in bounds]
+        self.reader = BlockReader(uri,var,blocks)
+        self.reader.start()
+        self.blocks = [None if o is None else blocks[o] for o in owner]
+        return(self.blocks)
+
+    def _count_(self,windows,bounds,owner):
+        "Update the chunk statistics for the planned blocks."
+        ## mark the chunks touched by the windows within each block
+        touched = [np.zeros([len(r) for r in self._chunk_ranges_(b)],dtype=bool) for b in bounds]
+        for window,o in zip(windows,owner):
+            if o is None:
+                continue
+            first = [r[0] for r in self._chunk_ranges_(bounds[o])]
+            sub = tuple(slice(r[0]-f,r[-1]+1-f) for r,f in zip(self._chunk_ranges_(window),first))
+            self.chunks_touched += touched[o][sub].size
+            touched[o][sub] = True
+        self.chunks_unique += sum(int(t.sum()) for t in touched)
+        self.chunks_decoded += sum(t.size for t in touched)
+
+    def _chunk_ranges_(self,window):
+        "Chunk indices covered by a window along each dimension."
+        return([xrange(start//c,-(-stop//c)) for (start,stop),c in zip(window,self.chunks)])
+
+
+def _overlap_groups_(boxes):
+    """
+    Groups of boxes connected by overlaps. Overlapping pairs are found in one
+    sort-and-sweep pass along the dimension the boxes are spread the most.
+
+    boxes -- sequence of boxes of half-open ranges
+
+    Returns a list of lists of box indices.
+    """
+    if len(boxes) == 0:
+        return([])
+    parent = range(len(boxes))
+    def _find(ii):
+        while parent[ii] != ii:
+            parent[ii] = parent[parent[ii]]
+            ii = parent[ii]
+        return(ii)
+    spread = [max(b[d][1] for b in boxes)-min(b[d][0] for b in boxes) for d in xrange(len(boxes[0]))]
+    axis = int(np.argmax(spread))
+    ## boxes whose range along the axis is still open
+    active = []
+    for ii in sorted(xrange(len(boxes)),key=lambda ii: boxes[ii][axis][0]):
+        start = boxes[ii][axis][0]
+        active = [jj for jj in active if boxes[jj][axis][1] > start]
+        for jj in active:
+            if _overlaps_(boxes[ii],boxes[jj]):
+                parent[_find(ii)] = _find(jj)
+        active.append(ii)
+    groups = {}
+    for ii in xrange(len(boxes)):
+        groups.setdefault(_find(ii),[]).append(ii)
+    return(sorted(groups.values()))
+
+
+def _union_(boxes):
+    "Smallest box containing all boxes."
+    return([(min(r[0] for r in dim),max(r[1] for r in dim)) for dim in zip(*boxes)])
+
+
+def _overlaps_(a,b):
+    "True if two boxes of half-open ranges intersect."
+    for (a0,a1),(b0,b1) in zip(a,b):
+        if a0 >= b1 or b0 >= a1:
+            return(False)
+    return(True)